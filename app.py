@@ -1,44 +1,148 @@
 import os
+from datetime import date
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from flask import Blueprint, Flask, current_app, render_template, request, flash, redirect, session, g, abort, jsonify
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
 
+from config import get_config
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Likes, Follows
+from passwords import PasswordPoolBusy
+import assets
+import fragments
+import images
+from loading import message_cards
+from httpcache import conditional, not_modified
+import passwords
+import pooling
+from pagination import COUNT_KEY, FEED_KEY, SCORE_KEY, keyset, make_page, page_args, page_url
+from projections import message_rows, select_messages, select_users, user_rows
+import querystats
+import replicas
+from replicas import read_only
+import search
+import timeline
+import usercache
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
-app.app_context().push() #where to put app.app_context().pop()?
+# every page and command; create_app() puts them on an app
+bp = Blueprint('warbler', __name__, cli_group=None)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+def create_app(config=None, **settings):
+    """Make a Warbler app.
 
-connect_db(app)
+    `config` is a profile name from config.py ('development', 'production',
+    'test', 'benchmark') or a settings object; by default the WARBLER_CONFIG
+    profile, or development. `settings` override single values.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(get_config(config))
+    app.config.update(settings)
+
+    if app.config['DEBUG_TOOLBAR']:
+        # only needed in development, and slow to import
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    pooling.init_app(app)
+    connect_db(app)
+    querystats.init_app(app)
+    replicas.init_app(app)
+    usercache.init_app(app)
+    passwords.init_app(app)
+    fragments.init_app(app)
+    assets.init_app(app)
+    images.init_app(app)
+
+    app.jinja_env.globals['page_url'] = page_url
+    app.register_blueprint(bp)
+
+    if app.config['DISPOSE_ENGINES_AFTER_FORK']:
+        dispose_engines_after_fork(app)
+
+    return app
+
+
+def dispose_engines_after_fork(app):
+    """Make forked workers open their own database connections.
+
+    A pre-forking server builds the app once and forks it; a connection the
+    parent already opened would otherwise be shared by every worker. The
+    children forget the parent's pool without closing its connections.
+    """
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    engines += app.extensions['replicas'].engines
+
+    def dispose():
+        for engine in engines:
+            engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=dispose)
+
+
+_default_app = None
+
+
+def __getattr__(name):
+    """`from app import app`: an app for the WARBLER_CONFIG profile, made on
+    first use, with its app context pushed (as scripts and tests expect).
+
+    Servers should call `create_app()` instead (see wsgi.py).
+    """
+
+    global _default_app
+
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    if _default_app is None:
+        _default_app = create_app()
+        _default_app.app_context().push()
+    return _default_app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user (and the ids of who they follow and what they've liked) comes
+    from the per-process user cache when possible. Static files skip this.
+    Those sets only go into ETags; pages render buttons from `viewer_ids()`.
+    """
+
+    g.user = None
+    g.following_ids = g.liked_ids = frozenset()
+
+    if request.endpoint in ('static', 'asset', 'image'):
+        return
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user, cached = usercache.load_user(session[CURR_USER_KEY])
+        if cached is not None:
+            g.following_ids = cached.following_ids
+            g.liked_ids = cached.liked_ids
 
-    else:
-        g.user = None
+
+def viewer_ids(user_ids=(), message_ids=()):
+    """(ids followed, ids liked) by the current user, among just these users
+    and messages: one query for what's on the page, fresh even when the
+    cached sets aren't."""
+
+    user_ids, message_ids = list(user_ids), list(message_ids)
+    if not g.user or not (user_ids or message_ids):
+        return frozenset(), frozenset()
+
+    return g.user.follow_and_like_ids(user_ids=user_ids, message_ids=message_ids)
 
 
 def do_login(user):
@@ -54,7 +158,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -90,7 +194,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -101,6 +205,8 @@ def login():
                                  form.password.data)
 
         if user:
+            #save the password hash if it was upgraded to the current cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -110,7 +216,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -122,42 +228,119 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
+@read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations; results are ranked and paginated.
     """
 
-    search = request.args.get('q')
+    term = request.args.get('q', '').strip()
+    # search ranks and follower counts are both ints
+    before, after, limit = page_args(COUNT_KEY)
 
-    if not search:
-        users = User.query.all()
+    if term:
+        page = search.search_users(term, before, after, limit)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = directory(before, after, limit)
+
+    following, _ = viewer_ids(user_ids=[user.id for user in page])
+
+    return render_template('users/index.html', users=page, page=page,
+                           following=following)
+
+
+def directory(before=None, after=None, limit=100):
+    """One page of every user, most followed first, as a `Page` of
+    `UserRow`s."""
+
+    rows = db.session.execute(keyset(
+        select_users().add_columns(User.followers_count),
+        (User.followers_count, User.id),
+        before, after, limit)).all()
 
-    return render_template('users/index.html', users=users)
+    page = make_page(rows, lambda r: (r.followers_count, r.id),
+                     before, after, limit)
+    page.items = user_rows(page.items)
+    return page
 
 
-@app.route('/users/<int:user_id>')
+def profile_version(user):
+    """Everything users/detail.html shows about `user`."""
+
+    return (user.id, user.username, user.image_url, user.header_image_url,
+            user.bio, user.location, user.messages_count, user.following_count,
+            user.followers_count, user.likes_count)
+
+
+@bp.route('/users/<int:user_id>')
+@read_only
+@conditional
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
+    # messages can't be edited: a new one moves the newest id, a deleted one
+    # changes the count (both come off the user_id index)
+    latest = db.session.execute(select(func.max(Message.id),
+                                       func.max(Message.timestamp))
+                                .where(Message.user_id == user_id)).one()
+    unchanged = not_modified(profile_version(user), tuple(latest))
+    if unchanged:
+        return unchanged
+
+    before, after, limit = page_args()
+    page = user_messages(user_id, before, after, limit)
+    following, _ = viewer_ids(user_ids=[user_id])
+    
+    return render_template('users/show.html', user=user, messages=page, page=page,
+                           following=following)
+
+
+def user_messages(user_id, before=None, after=None, limit=100):
+    """One page of a user's own messages, newest first, as a `Page` of
+    `MessageRow`s."""
+
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    
-    return render_template('users/show.html', user=user, messages=messages)
+    messages = message_rows(db.session.execute(keyset(
+        select_messages().where(Message.user_id == user_id),
+        (Message.timestamp, Message.id),
+        before, after, limit)))
+    return make_page(messages, lambda m: (m.timestamp, m.id),
+                     before, after, limit)
+
 
+def listed_users(key, user_id, before=None, after=None, limit=100):
+    """One page of everyone joined to `user_id` through Follows.`key`:
+    whoever they follow, or whoever follows them. Most recently followed
+    first, as a `Page`.
 
-@app.route('/users/<int:user_id>/following')
+    `UserRow`s, not `User`s: the follow pages only show these columns.
+    """
+
+    other = (Follows.user_being_followed_id if key == 'user_following_id'
+             else Follows.user_following_id)
+
+    # one range scan on ix_follows_following_created / _followed_created
+    rows = db.session.execute(keyset(
+        select_users().add_columns(Follows.created_at)
+        .join(Follows, other == User.id)
+        .where(getattr(Follows, key) == user_id),
+        (Follows.created_at, other),
+        before, after, limit)).all()
+
+    page = make_page(rows, lambda r: (r.created_at, r.id), before, after, limit)
+    page.items = user_rows(page.items)
+    return page
+
+
+@bp.route('/users/<int:user_id>/following')
+@read_only
+@conditional
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,10 +349,24 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+
+    # one query for the page, used to check the ETag too
+    before, after, limit = page_args()
+    followed = listed_users('user_following_id', user_id, before, after, limit)
+    unchanged = not_modified(profile_version(user), followed.items,
+                             followed.newer, followed.older)
+    if unchanged:
+        return unchanged
+
+    following, _ = viewer_ids(user_ids=[user_id] + [u.id for u in followed])
+
+    return render_template('users/following.html', user=user, users=followed,
+                           page=followed, following=following)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
+@read_only
+@conditional
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -178,10 +375,22 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
 
+    # one query for the page, used to check the ETag too
+    before, after, limit = page_args()
+    followers = listed_users('user_being_followed_id', user_id, before, after, limit)
+    unchanged = not_modified(profile_version(user), followers.items,
+                             followers.newer, followers.older)
+    if unchanged:
+        return unchanged
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+    following, _ = viewer_ids(user_ids=[user_id] + [u.id for u in followers])
+
+    return render_template('users/followers.html', user=user, users=followers,
+                           page=followers, following=following)
+
+
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -190,13 +399,24 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
+
+    #following yourself, or someone twice, would break the timeline backfill
+    if followed_user.id == g.user.id or g.user.is_following(followed_user):
+        return redirect(f"/users/{g.user.id}/following")
+
     g.user.following.append(followed_user)
+    db.session.flush()
+
+    User.adjust_counts(g.user.id, following_count=1)
+    User.adjust_counts(followed_user.id, followers_count=1)
+    timeline.backfill(g.user.id, followed_user.id)
     db.session.commit()
+    usercache.invalidate(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -204,14 +424,24 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
+    followed_user = User.query.get_or_404(follow_id)
+
+    #not following them (any more): nothing to undo, and no counters to touch
+    if not g.user.is_following(followed_user):
+        return redirect(f"/users/{g.user.id}/following")
+
     g.user.following.remove(followed_user)
+
+    User.adjust_counts(g.user.id, following_count=-1)
+    User.adjust_counts(follow_id, followers_count=-1)
+    timeline.prune_author(g.user.id, follow_id)
     db.session.commit()
+    usercache.invalidate(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
     
@@ -222,7 +452,8 @@ def profile():
     form = UserUpdateForm(obj=g.user)
     
     if form.validate_on_submit():
-        is_auth = User.authenticate(g.user.username, form.password.data)
+        #check against the user we already have rather than looking them up again
+        is_auth = g.user.check_password(form.password.data)
         
         if is_auth:
             g.user.username = form.username.data
@@ -232,6 +463,8 @@ def profile():
             g.user.bio = form.bio.data
             
             db.session.commit()
+            usercache.invalidate(g.user.id)
+            #cached message cards notice the new username/image by themselves
             
             return redirect(f"/users/{g.user.id}")
         
@@ -241,7 +474,7 @@ def profile():
     return render_template("users/edit.html", form=form, user_id=g.user.id)
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -251,8 +484,29 @@ def delete_user():
 
     do_logout()
 
+    #the counters of everyone this user followed / was followed by go down
+    (User.query
+     .filter(User.id.in_(db.select(Follows.user_being_followed_id)
+                         .where(Follows.user_following_id == g.user.id)))
+     .update({User.followers_count: User.followers_count - 1},
+             synchronize_session=False))
+    (User.query
+     .filter(User.id.in_(db.select(Follows.user_following_id)
+                         .where(Follows.user_being_followed_id == g.user.id)))
+     .update({User.following_count: User.following_count - 1},
+             synchronize_session=False))
+
+    user_id = g.user.id
+
+    #their messages go too, and with them the likes of everyone who liked one
+    Likes.remove_for_messages(db.select(Message.id).where(Message.user_id == user_id))
+    timeline.forget_user(user_id)
+    Message.query.filter(Message.user_id == user_id).delete(synchronize_session=False)
+    db.session.expire(g.user, ['messages'])
+
     db.session.delete(g.user)
     db.session.commit()
+    usercache.invalidate(user_id)
 
     return redirect("/signup")
 
@@ -260,7 +514,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -276,22 +530,67 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+
+        User.adjust_counts(g.user.id, messages_count=1)
+        timeline.fan_out(msg)
         db.session.commit()
+        usercache.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/search')
+@read_only
+def messages_search():
+    """Full-text search over messages.
+
+    Takes 'q' (search words), optional 'since' / 'until' dates (YYYY-MM-DD)
+    and 'sort' ('recent' or 'rank'). Results are paginated.
+    """
+
+    term = request.args.get('q', '').strip()
+    order = 'rank' if request.args.get('sort') == 'rank' else 'recent'
+
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        since = date.fromisoformat(since) if since else None
+        until = date.fromisoformat(until) if until else None
+    except ValueError:
+        abort(400)
+
+    page = None
+    if term:
+        before, after, limit = page_args(SCORE_KEY if order == 'rank' else FEED_KEY)
+        page = search.search_messages(term, since, until, order,
+                                      before, after, limit)
+
+    return render_template('messages/search.html', page=page, term=term,
+                           since=since, until=until, order=order)
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
+@read_only
+@conditional(anonymous='public, max-age=0, s-maxage=300')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.options(*message_cards()).get_or_404(message_id)
+
+    # messages never change; only their author's name and picture might
+    unchanged = not_modified(msg.id, fragments.card_version(msg))
+    if unchanged:
+        return unchanged
+
+    following, _ = viewer_ids(user_ids=[msg.user_id])
 
+    return render_template('messages/show.html', message=msg, following=following)
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -306,35 +605,64 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
+    timeline.prune_message(msg.id)
+    Likes.remove_for_messages([msg.id])
+    User.adjust_counts(g.user.id, messages_count=-1)
     db.session.delete(msg)
     db.session.commit()
+    usercache.invalidate(g.user.id)
+    fragments.invalidate(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
 ##############################################################################
 # Likes Routes
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
+@read_only
+@conditional
 def show_likes(user_id):
     """Show list of likes of this user."""
 
     user = User.query.get_or_404(user_id)
-
-    liked_messages = user.likes
-    likes_ids = [msg.id for msg in liked_messages]
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    
+    before, after, limit = page_args()
+
+    # newest liked messages first, a page at a time
+    liked_messages = keyset(Message
+                            .query
+                            .options(*message_cards())
+                            .join(Likes, Likes.message_id == Message.id)
+                            .filter(Likes.user_id == user_id),
+                            (Message.timestamp, Message.id),
+                            before, after, limit).all()
+    page = make_page(liked_messages, lambda m: (m.timestamp, m.id),
+                     before, after, limit)
+
+    # the page is already loaded; what's saved is rendering it
+    unchanged = not_modified(profile_version(user),
+                             [fragments.card_version(msg) for msg in page])
+    if unchanged:
+        return unchanged
+
+    # what the viewer (not `user`) follows and likes
+    following, liked = viewer_ids(user_ids=[user_id],
+                                  message_ids=[msg.id for msg in page])
     
     return render_template('users/likes.html', 
                            user=user, 
-                           liked_messages=liked_messages, 
-                           likes=likes_ids)
+                           liked_messages=page, 
+                           following=following,
+                           liked=liked,
+                           page=page)
     
     
-@app.route('/users/add_like/<int:message_id>', methods=["POST"])
+@bp.route('/users/add_like/<int:message_id>', methods=["POST"])
 def likes(message_id):
-    """Add or delete message from user likes"""
+    """Add or delete message from user likes.
+
+    Form fallback for browsers without JavaScript; likes.js uses the JSON
+    API below instead.
+    """
 
     if not g.user:
             flash("Access unauthorized.", "danger")
@@ -343,58 +671,178 @@ def likes(message_id):
     msg = Message.query.get_or_404(message_id)
     
     #if message is already in likes, unlike
-    if msg in g.user.likes:
-        g.user.likes.remove(msg)
-        db.session.commit()
-        return redirect('/')
-        
-    g.user.likes.append(msg)
+    set_like(msg.id, not g.user.has_liked(msg))
+
+    return redirect(request.referrer or '/')
+
+
+def set_like(message_id, liked):
+    """Like (or unlike) a message as g.user and commit.
+
+    Idempotent: repeating it changes nothing, counters included.
+    """
+
+    if liked:
+        changed = Likes.add(g.user.id, message_id)
+    else:
+        changed = Likes.remove(g.user.id, message_id)
+
+    if changed:
+        User.adjust_counts(g.user.id, likes_count=1 if liked else -1)
+
     db.session.commit()
-    return redirect('/')
+
+    if changed:
+        usercache.invalidate(g.user.id)
+
+    return changed
+
+
+@bp.route('/api/messages/<int:message_id>/like', methods=["PUT", "DELETE"])
+def api_like(message_id):
+    """Like (PUT) or unlike (DELETE) a message.
+
+    Returns JSON like {"message_id": 1, "liked": true, "likes": 3}, where
+    "likes" is how many users now like the message. Both are idempotent.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    liked = request.method == 'PUT'
+
+    #nothing changed: either a repeat, or there's no such message
+    if not set_like(message_id, liked) and db.session.get(Message, message_id) is None:
+        return jsonify(error="No such message."), 404
+
+    return jsonify(message_id=message_id, liked=liked,
+                   likes=Likes.count_for(message_id))
 
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
+@read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
     
     if g.user:
-        following_id = [user.id for user in g.user.following] #get ids of users following
-        likes_ids = [msg.id for msg in g.user.likes]
+        before, after, limit = page_args()
         
-        messages = (Message
-                    .query
-                    .filter((Message.user_id.in_(following_id)) | (Message.user_id == g.user.id)) #filter messages by users following or user
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        #read the precomputed timeline instead of joining through follows
+        page = timeline.home_feed(g.user.id, before, after, limit)
+        _, liked = viewer_ids(message_ids=[msg.id for msg in page])
 
-        return render_template('home.html', messages=messages, likes=likes_ids)
+        return render_template('home.html', messages=page, liked=liked, page=page)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching headers
+#
+# Pages are not cached unless their route says otherwise: routes decorated
+# with @conditional (httpcache.py) set their own Cache-Control and ETag.
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses that didn't set their own."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
+    if 'Cache-Control' not in req.headers:
+        req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        req.headers["Pragma"] = "no-cache"
+        req.headers["Expires"] = "0"
     return req
+
+
+@bp.app_errorhandler(PasswordPoolBusy)
+def password_pool_busy(err):
+    """Too many logins/signups in flight: fail fast instead of queueing."""
+
+    return ("Warbler is busy right now, please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
+@bp.app_errorhandler(PoolTimeout)
+def db_pool_exhausted(err):
+    """No database connection came free within DB_POOL_TIMEOUT: fail fast
+    instead of piling more requests onto the queue."""
+
+    db.session.rollback()
+    return ("Warbler is busy right now, please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
+##############################################################################
+# Internal stats
+
+
+@bp.route('/_stats/user-cache')
+def user_cache_stats():
+    """Hit/miss counters of this process's current-user cache.
+
+    Only served when EXPOSE_INTERNAL_STATS is set (or in debug mode).
+    """
+
+    if not (current_app.debug or current_app.config.get('EXPOSE_INTERNAL_STATS')):
+        abort(404)
+
+    return jsonify(usercache.get_cache().stats())
+
+
+@bp.route('/_stats/db-pool')
+def db_pool_stats():
+    """Checkout waits, timeouts and saturation of each database pool.
+
+    Only served when EXPOSE_INTERNAL_STATS is set (or in debug mode).
+    """
+
+    if not (current_app.debug or current_app.config.get('EXPOSE_INTERNAL_STATS')):
+        abort(404)
+
+    engines = {'primary': db.engine}
+    for n, engine in enumerate(current_app.extensions['replicas'].engines):
+        engines[f'replica{n}'] = engine
+
+    return jsonify(pooling.pool_metrics(engines))
+
+
+##############################################################################
+# Commands
+
+
+@bp.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild every user's home timeline from messages and follows."""
+
+    pooling.lift_statement_timeout(db.session.connection())
+    timeline.rebuild()
+    db.session.commit()
+
+
+@bp.cli.command('reindex-search')
+def reindex_search_command():
+    """Rebuild the user and message search indexes, e.g. after a bulk load."""
+
+    with db.engine.begin() as conn:
+        pooling.lift_statement_timeout(conn)
+        search.reindex(conn)
+
+
+@bp.cli.command('reconcile-counts')
+def reconcile_counts_command():
+    """Recompute the denormalized user counters and fix any drift."""
+
+    pooling.lift_statement_timeout(db.session.connection())
+    fixed = User.reconcile_counts()
+    db.session.commit()
+    print(f"Fixed counters for {fixed} user(s).")
@@ -0,0 +1,93 @@
+"""Fingerprinted static files, built by build_assets.py.
+
+`asset_url('stylesheets/style.css')` in a template gives the URL of the
+hashed copy (/static/dist/stylesheets/style.1a2b3c4d5e.css) when there's a
+build, or the plain /static/ URL when there isn't (e.g. in development).
+
+Hashed files never change, so they're sent with a one-year `immutable`
+Cache-Control. When the client accepts it, the precompressed .br or .gz copy
+is sent instead. Production should serve /static/dist/ from the web server
+(see build_assets.py), so these requests never reach Python. The route here
+is the fallback, and it skips loading the user.
+
+Settings:
+
+- ASSET_MANIFEST: path of the build's manifest.json (default:
+  static/dist/manifest.json). It's read once at startup, so restart the app
+  after a build.
+"""
+
+import json
+import mimetypes
+import os
+
+from flask import current_app, request, send_from_directory, url_for
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class Assets:
+    """A build's manifest and the directory it's in."""
+
+    def __init__(self, manifest_path):
+        self.directory = os.path.dirname(manifest_path)
+
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+
+        self.files = manifest.get('files', {})
+        self.compressed = manifest.get('compressed', {})
+
+
+def get_assets():
+    return current_app.extensions['assets']
+
+
+def asset_url(path):
+    """URL of static file `path`, fingerprinted when it's been built."""
+
+    hashed = get_assets().files.get(path)
+    if hashed is None:
+        return url_for('static', filename=path)
+    return url_for('asset', filename=hashed)
+
+
+def send_asset(filename):
+    """Serve a hashed file, precompressed if the client takes it."""
+
+    assets = get_assets()
+    mimetype = mimetypes.guess_type(filename)[0]
+    available = assets.compressed.get(filename, ())
+
+    for encoding, suffix in ENCODINGS:
+        if encoding in available and request.accept_encodings[encoding]:
+            resp = send_from_directory(assets.directory, filename + suffix,
+                                       mimetype=mimetype, max_age=ONE_YEAR)
+            resp.headers['Content-Encoding'] = encoding
+            break
+    else:
+        resp = send_from_directory(assets.directory, filename,
+                                   mimetype=mimetype, max_age=ONE_YEAR)
+
+    resp.cache_control.immutable = True
+    if available:
+        resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def init_app(app):
+    """Load the asset manifest and add the `asset_url()` template global."""
+
+    manifest = app.config.get(
+        'ASSET_MANIFEST', os.path.join(app.static_folder, 'dist', 'manifest.json'))
+    app.extensions['assets'] = Assets(manifest)
+
+    app.add_url_rule(f"{app.static_url_path}/dist/<path:filename>",
+                     endpoint='asset', view_func=send_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
@@ -0,0 +1,404 @@
+"""Micro-benchmarks for the model and query hot paths.
+
+Times each of these in isolation, against a generated dataset in a scratch
+SQLite database (or --db, to reuse one between runs):
+
+- signup / authenticate: `User.signup()` and `User.authenticate()`, at the
+  configured bcrypt cost
+- is_following: `User.is_following()`
+- home_feed: the homepage feed query (`timeline.home_feed()`)
+- users_show: the profile page query (`user_messages()`)
+- render_home / render_users_show: rendering home.html and users/show.html
+  for an already loaded page
+- feed_orm_N / feed_rows_N: loading and rendering a page of the N newest
+  messages (N = 100, 1000) as ORM objects or as projection rows (see
+  projections.py); the peak memory of one page is reported as peak_kb
+- cold_start: a new process importing and building the production app, as a
+  server worker does (its peak memory is reported as max_rss_kb)
+
+Results are compared with a baseline file, and the run fails (exit status 1)
+if any benchmark got slower by more than --threshold:
+
+    python bench.py --save                  # record bench-baseline.json
+    python bench.py                         # compare against it
+    python bench.py --users 20000 --messages 500000 --only home_feed
+
+Timings only compare on the same machine and dataset size, so baselines
+aren't meant to be shared.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register `setup()`, which prepares and returns the function to time."""
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def measure(fn, repeat, min_time):
+    """Per-call seconds for `fn` over `repeat` batches.
+
+    Batches are sized so each takes about `min_time / repeat` seconds.
+    """
+
+    def batch(number):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        return time.perf_counter() - started
+
+    number = 1
+    target = min_time / repeat
+    while True:
+        elapsed = batch(number)
+        if elapsed >= target or number >= 1 << 20:
+            break
+        number = max(number * 2, int(number * target / max(elapsed, 1e-9)))
+
+    times = [batch(number) / number for _ in range(repeat)]
+    return {
+        'median_us': round(statistics.median(times) * 1e6, 2),
+        'min_us': round(min(times) * 1e6, 2),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def build_dataset(args):
+    """Generate CSVs of the requested size and load them into the database."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(
+            [sys.executable, os.path.join(HERE, 'generator', 'create_csvs.py'),
+             '--out', tmp, '--workers', '1', '--seed', args.seed,
+             '--users', str(args.users), '--messages', str(args.messages),
+             '--follows', str(args.follows)],
+            check=True)
+
+        import load_data
+        load_data.load(tmp, reset=True)
+
+
+def pick_user():
+    """Id of the user following the most people: the busiest home feed."""
+
+    from sqlalchemy import func, select
+    from models import db, Follows
+
+    return db.session.scalar(
+        select(Follows.user_following_id)
+        .group_by(Follows.user_following_id)
+        .order_by(func.count().desc())
+        .limit(1))
+
+
+def pick_author():
+    """Id of the user with the most messages: the longest profile page."""
+
+    from sqlalchemy import select
+    from models import db, User
+
+    return db.session.scalar(
+        select(User.id).order_by(User.messages_count.desc()).limit(1))
+
+
+@benchmark('signup')
+def bench_signup():
+    from models import db, User
+
+    count = iter(range(10 ** 9))
+
+    def run():
+        n = next(count)
+        User.signup(f"bench_{n}", f"bench_{n}@example.com", 'password', None)
+        db.session.flush()
+        db.session.rollback()
+
+    return run
+
+
+@benchmark('authenticate')
+def bench_authenticate():
+    from models import db, User
+
+    username = db.session.get(User, pick_user()).username
+    return lambda: User.authenticate(username, 'password')
+
+
+@benchmark('is_following')
+def bench_is_following():
+    from models import db, Follows, User
+
+    follow = Follows.query.first()
+    follower = db.session.get(User, follow.user_following_id)
+    followed = db.session.get(User, follow.user_being_followed_id)
+
+    return lambda: follower.is_following(followed)
+
+
+@benchmark('home_feed')
+def bench_home_feed():
+    import timeline
+
+    user_id = pick_user()
+    return lambda: timeline.home_feed(user_id)
+
+
+@benchmark('users_show')
+def bench_users_show():
+    from app import user_messages
+
+    user_id = pick_author()
+    return lambda: user_messages(user_id)
+
+
+def render(template, user_id, **context):
+    """Function rendering `template` as `user_id` would see it."""
+
+    from flask import current_app, g, render_template
+    from models import db, User
+
+    def run():
+        with current_app.test_request_context('/'):
+            g.user = db.session.get(User, user_id)
+            render_template(template, **context)
+
+    # the first render compiles the template and fills the card cache; don't time that
+    run()
+    return run
+
+
+@benchmark('render_home')
+def bench_render_home():
+    import timeline
+    from models import db, User
+
+    user_id = pick_user()
+    page = timeline.home_feed(user_id)
+    liked = db.session.get(User, user_id).follow_and_like_ids(
+        message_ids=[msg.id for msg in page])[1]
+
+    return render('home.html', user_id, messages=page, liked=liked, page=page)
+
+
+@benchmark('render_users_show')
+def bench_render_users_show():
+    from app import user_messages
+    from models import db, User
+
+    user_id = pick_author()
+    page = user_messages(user_id)
+
+    return render('users/show.html', user_id,
+                  user=db.session.get(User, user_id), messages=page, page=page,
+                  following=frozenset())
+
+
+def feed_page(load, rows):
+    """Function loading the `rows` newest messages with `load(rows)` and
+    rendering them as a profile page; also records the peak memory of one
+    page."""
+
+    from flask import current_app, g, render_template
+    from models import db, User
+    from pagination import Page
+
+    user_id = pick_author()
+
+    def run():
+        # start from an empty session, as a request does
+        db.session.expunge_all()
+        with current_app.test_request_context('/'):
+            g.user = user = db.session.get(User, user_id)
+            page = Page(load(rows))
+            render_template('users/show.html', user=user, messages=page, page=page,
+                            following=frozenset())
+
+    # warm the template and card caches before measuring
+    run()
+    tracemalloc.start()
+    run()
+    run.extra = {'peak_kb': tracemalloc.get_traced_memory()[1] // 1024}
+    tracemalloc.stop()
+
+    return run
+
+
+def orm_messages(rows):
+    from loading import message_cards
+    from models import Message
+
+    return (Message.query
+            .options(*message_cards())
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(rows)
+            .all())
+
+
+def projected_messages(rows):
+    from models import db, Message
+    from projections import message_rows, select_messages
+
+    return message_rows(db.session.execute(
+        select_messages()
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(rows)))
+
+
+for rows in (100, 1000):
+    benchmark(f'feed_orm_{rows}')(lambda rows=rows: feed_page(orm_messages, rows))
+    benchmark(f'feed_rows_{rows}')(lambda rows=rows: feed_page(projected_messages, rows))
+
+
+STARTUP = '''
+import resource, sys
+sys.path.insert(0, {here!r})
+from app import create_app
+create_app('production')
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+@benchmark('cold_start')
+def bench_cold_start():
+    """A fresh interpreter importing and building the production app, as
+    each server process does; also records its peak memory."""
+
+    code = STARTUP.format(here=HERE)
+
+    def run():
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             capture_output=True, text=True).stdout
+        # KB on Linux
+        run.extra['max_rss_kb'] = max(run.extra.get('max_rss_kb', 0),
+                                      int(out.split()[-1]))
+
+    run.extra = {}
+    return run
+
+
+def compare(results, baseline, threshold):
+    """Print each benchmark against the baseline; names of regressions."""
+
+    regressions = []
+
+    for name, result in results.items():
+        before = baseline.get(name)
+        memory = ''.join(f"   {result[key]:,} KB peak" for key in ('max_rss_kb', 'peak_kb')
+                         if key in result)
+
+        if before is None:
+            print(f"{name:20} {result['median_us']:>12,.1f} us   (no baseline){memory}")
+            continue
+
+        change = result['median_us'] / before['median_us'] - 1
+        slower = change > threshold
+        if slower:
+            regressions.append(name)
+
+        print(f"{name:20} {result['median_us']:>12,.1f} us   "
+              f"{change:+7.1%} vs {before['median_us']:,.1f} us"
+              f"{'   SLOWER' if slower else ''}{memory}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=40000)
+    parser.add_argument('--seed', default='bench')
+    parser.add_argument('--db', help="SQLite file to use (and keep); built if empty")
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS),
+                        help="run just this benchmark (repeatable)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="timed batches per benchmark (default: 5)")
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help="seconds to spend timing each benchmark (default: 1)")
+    parser.add_argument('--baseline', default='bench-baseline.json',
+                        help="baseline file (default: bench-baseline.json)")
+    parser.add_argument('--save', action='store_true',
+                        help="write these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed slowdown before failing (default: 0.25 = 25%%)")
+    args = parser.parse_args()
+
+    scratch = None
+    if args.db is None:
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        args.db = scratch.name
+
+    # must be set before the config is imported
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.abspath(args.db)}"
+
+    from sqlalchemy import inspect
+    from models import db, Follows, Message, User
+    from app import create_app
+
+    create_app('benchmark').app_context().push()
+
+    try:
+        if not inspect(db.engine).has_table('users') or User.query.count() == 0:
+            build_dataset(args)
+
+        dataset = {'users': User.query.count(),
+                   'messages': Message.query.count(),
+                   'follows': Follows.query.count()}
+
+        results = {}
+        for name in args.only or BENCHMARKS:
+            fn = BENCHMARKS[name]()
+            results[name] = measure(fn, args.repeat, args.min_time)
+            results[name].update(getattr(fn, 'extra', {}))
+            db.session.rollback()
+
+    finally:
+        db.session.remove()
+        db.engine.dispose()
+        if scratch is not None:
+            os.remove(scratch.name)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved.get('dataset') == dataset:
+            baseline = saved['results']
+        else:
+            print(f"baseline {args.baseline} is for a different dataset; not comparing",
+                  file=sys.stderr)
+
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'dataset': dataset, 'results': {**baseline, **results}},
+                      f, indent=2)
+            f.write('\n')
+        print(f"saved {args.baseline}")
+
+    elif regressions:
+        print(f"slower by more than {args.threshold:.0%}: {', '.join(regressions)}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
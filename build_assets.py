@@ -0,0 +1,176 @@
+"""Build fingerprinted, precompressed copies of the static files.
+
+Every file under static/ is copied into static/dist/, and its content hash is
+added to the name (stylesheets/style.css -> stylesheets/style.1a2b3c4d5e.css).
+A new build gives changed files new names, so browsers and CDNs can keep
+these copies for a year without revalidating.
+
+Text files (CSS, JS, SVG, ...) also get a gzip copy next to them (.gz), and a
+brotli copy (.br) when the `brotli` package is installed. That way nothing
+has to compress them per request. CSS url()s that point at other static
+files are rewritten to the hashed names.
+
+static/dist/manifest.json maps the original paths to the hashed ones. It is
+written last, so a running app never sees names that aren't on disk yet.
+assets.py reads it for the `asset_url()` template helper. Old builds are
+left in place, because pages cached elsewhere may still refer to them; pass
+--clean to start over.
+
+    python build_assets.py
+    python build_assets.py --clean
+
+In production, let the web server serve /static/dist/ straight from disk,
+e.g. with nginx:
+
+    location /static/dist/ {
+        gzip_static on;
+        brotli_static on;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }
+"""
+
+import argparse
+import gzip
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+from hashlib import blake2b
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SOURCE = os.path.join(HERE, 'static')
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# worth compressing; images are compressed already
+TEXT_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map', '.html'}
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)/static/([^'")?#]+)([^'")]*)\1\s*\)''')
+
+
+def fingerprint(path, data):
+    """`path` with a hash of `data` before its extension."""
+
+    base, ext = posixpath.splitext(path)
+    return f"{base}.{blake2b(data, digest_size=5).hexdigest()}{ext}"
+
+
+def rewrite_css(path, data, files):
+    """Point url(/static/...) references at the hashed files.
+
+    The new urls are relative, so the build works wherever it's mounted.
+    """
+
+    def replace(match):
+        quote, target, rest = match.groups()
+        hashed = files.get(target)
+        if hashed is None:
+            return match.group(0)
+        url = posixpath.relpath(hashed, posixpath.dirname(path))
+        return f"url({quote}{url}{rest}{quote})"
+
+    return CSS_URL.sub(replace, data.decode()).encode()
+
+
+def compress(data):
+    """{encoding: compressed bytes}, for encodings that make `data` smaller."""
+
+    variants = {'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+
+    return {encoding: body for encoding, body in variants.items()
+            if len(body) < len(data)}
+
+
+SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+def source_files(source, out):
+    """Paths (relative, with /) of everything to build, CSS last so the
+    files it refers to already have their hashed names."""
+
+    paths = []
+    for root, dirs, names in os.walk(source):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.abspath(os.path.join(root, d)) != out)
+        for name in names:
+            rel = os.path.relpath(os.path.join(root, name), source)
+            paths.append(rel.replace(os.sep, '/'))
+
+    return sorted(paths, key=lambda p: (p.endswith('.css'), p))
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build(source=SOURCE, out=None, clean=False):
+    """Build `source` into `out` (default: its dist/); returns the manifest."""
+
+    out = out or os.path.join(source, DIST)
+    if clean and os.path.isdir(out):
+        shutil.rmtree(out)
+
+    files = {}
+    compressed = {}
+
+    for rel in source_files(source, os.path.abspath(out)):
+        with open(os.path.join(source, rel), 'rb') as f:
+            data = f.read()
+
+        if rel.endswith('.css'):
+            data = rewrite_css(rel, data, files)
+
+        hashed = fingerprint(rel, data)
+        files[rel] = hashed
+        write(os.path.join(out, hashed), data)
+
+        if posixpath.splitext(rel)[1].lower() in TEXT_EXTENSIONS:
+            variants = compress(data)
+            for encoding, body in variants.items():
+                write(os.path.join(out, hashed + SUFFIXES[encoding]), body)
+            if variants:
+                compressed[hashed] = sorted(variants)
+
+    manifest = {'files': files, 'compressed': compressed}
+
+    os.makedirs(out, exist_ok=True)
+    tmp = os.path.join(out, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp, os.path.join(out, MANIFEST))
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default=SOURCE,
+                        help="static directory to build (default: static/)")
+    parser.add_argument('--out', help="where to write (default: <source>/dist)")
+    parser.add_argument('--clean', action='store_true',
+                        help="remove earlier builds first")
+    args = parser.parse_args()
+
+    manifest = build(args.source, args.out, args.clean)
+
+    print(f"{len(manifest['files'])} files, {len(manifest['compressed'])} "
+          f"precompressed", file=sys.stderr)
+    if brotli is None:
+        print("brotli isn't installed; wrote gzip only", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Settings profiles for `create_app()`.
+
+Pick one by name: `create_app('production')`, or set WARBLER_CONFIG for
+`flask run`, the scripts and `from app import app`. Database URLs and the
+secret key come from the environment in every profile:
+
+- DATABASE_URL: primary database (default postgresql:///warbler)
+- DATABASE_REPLICA_URLS: comma separated read replicas (see replicas.py)
+- SECRET_KEY
+"""
+
+import os
+
+
+def replica_urls():
+    return [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url]
+
+
+class Config:
+    """Settings every profile shares."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///warbler')
+    SQLALCHEMY_REPLICA_URIS = replica_urls()
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # install flask-debugtoolbar (it still only shows in debug mode)
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # drop inherited database connections in forked workers
+    DISPOSE_ENGINES_AFTER_FORK = False
+
+
+class DevelopmentConfig(Config):
+    """`flask run` on a laptop."""
+
+    DEBUG_TOOLBAR = True
+
+    # fail on N+1 queries in list pages (see loading.py)
+    RAISE_ON_LAZY_LOAD = True
+
+
+class ProductionConfig(Config):
+    """Behind a pre-forking server, e.g. `gunicorn --preload wsgi:app`.
+
+    The app is built once in the master and forked. Each worker opens its own
+    database connections.
+    """
+
+    DISPOSE_ENGINES_AFTER_FORK = True
+
+    # cancel runaway queries (see pooling.py)
+    DB_STATEMENT_TIMEOUT_MS = 5000
+
+
+class TestConfig(Config):
+    """The test suite; DATABASE_URL points at the test database."""
+
+    WTF_CSRF_ENABLED = False
+    RAISE_ON_LAZY_LOAD = True
+
+
+class BenchmarkConfig(Config):
+    """bench.py: production-like, minus the forking."""
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'test': TestConfig,
+    'benchmark': BenchmarkConfig,
+}
+
+
+def get_config(config=None):
+    """Settings object for a profile name, or `config` itself if it's
+    already one."""
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'development')
+
+    if isinstance(config, str):
+        try:
+            return PROFILES[config]
+        except KeyError:
+            raise ValueError(f"unknown config profile {config!r}; "
+                             f"expected one of {', '.join(PROFILES)}")
+
+    return config
@@ -0,0 +1,120 @@
+"""Show the query plans behind each page, to check the indexes are used.
+
+Requests every main route through the Flask test client (logged in as one
+user), captures the SELECTs each one runs, and prints EXPLAIN for them:
+`EXPLAIN` on PostgreSQL, `EXPLAIN QUERY PLAN` on SQLite. Plans that scan a
+whole table are marked with `!!`.
+
+    python explain.py                # as the most-followed user
+    python explain.py --user-id 42
+
+Point DATABASE_URL at a seeded database first; on an empty one the planner
+has nothing to choose between.
+"""
+
+import argparse
+import re
+
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Likes, Message, User
+from querystats import statement_shape
+
+# a plan line that reads a whole table
+FULL_SCAN = re.compile(r"Seq Scan|^\s*SCAN (?!.*USING (?:COVERING )?INDEX)", re.M)
+
+
+def routes_for(user_id):
+    """(label, url) of the pages to explain for this user."""
+
+    message_id = db.session.scalar(
+        select(Message.id).where(Message.user_id == user_id).limit(1))
+    liked_id = db.session.scalar(
+        select(Likes.message_id).where(Likes.user_id == user_id).limit(1))
+
+    routes = [
+        ('homepage', '/'),
+        ('users_show', f'/users/{user_id}'),
+        ('show_following', f'/users/{user_id}/following'),
+        ('users_followers', f'/users/{user_id}/followers'),
+        ('show_likes', f'/users/{user_id}/likes'),
+        ('list_users', '/users'),
+    ]
+    if message_id or liked_id:
+        routes.append(('messages_show', f'/messages/{message_id or liked_id}'))
+
+    return routes
+
+
+def capture(client, url):
+    """Run one GET and return the distinct SELECTs it issued."""
+
+    seen = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            seen.setdefault(statement_shape(statement), (statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+    return resp.status_code, list(seen.values())
+
+
+def explain(statement, parameters):
+    """Plan lines for one captured statement."""
+
+    prefix = ('EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite'
+              else 'EXPLAIN ')
+
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+
+    # sqlite returns (id, parent, notused, detail); postgres one text column
+    return [str(row[-1]) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--user-id', type=int,
+                        help="user to log in as (default: most followed)")
+    args = parser.parse_args()
+
+    user_id = args.user_id or db.session.scalar(
+        select(Follows.user_being_followed_id)
+        .group_by(Follows.user_being_followed_id)
+        .order_by(func.count().desc())
+        .limit(1)) or db.session.scalar(select(func.min(User.id)))
+
+    if user_id is None:
+        raise SystemExit("No users; seed the database first.")
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    full_scans = 0
+
+    for label, url in routes_for(user_id):
+        status, statements = capture(client, url)
+        print(f"\n=== {label}  GET {url}  -> {status}, {len(statements)} distinct SELECTs")
+
+        for statement, parameters in statements:
+            plan = explain(statement, parameters)
+            flagged = any(FULL_SCAN.search(line) for line in plan)
+            full_scans += flagged
+
+            print(f"\n{'!!' if flagged else '--'} {statement_shape(statement)[:160]}")
+            for line in plan:
+                print(f"     {line}")
+
+    print(f"\n{full_scans} plan(s) with full table scans.")
+
+
+if __name__ == '__main__':
+    main()
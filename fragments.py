@@ -0,0 +1,71 @@
+"""Cache of rendered message cards.
+
+The card for a message (avatar, username, date, text) looks the same to every
+viewer, but every timeline, profile and likes page rendered it again for each
+message on each request. `message_card(msg)` renders it once and then serves
+the HTML from a bounded LRU cache.
+
+Entries are keyed by message id and remember a version: a hash of the
+author's username / image_url (and of the message itself). A card rendered
+before the author changed their profile is re-rendered rather than served
+stale, on every worker, with no invalidation message; so is one whose id
+was reused by a new message. Deleting a message drops its card with
+`invalidate()`.
+
+Anything that depends on the viewer, like the like button, stays outside
+the card in the page template.
+
+Settings: FRAGMENT_CACHE_SIZE (cards, default 10000; 0 disables the cache).
+"""
+
+from hashlib import blake2b
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from caching import LRUCache
+
+
+def card_version(msg):
+    """Short hash of everything a card shows: the author's username and
+    image, and the message."""
+
+    user = msg.user
+    data = (f"{user.id}\0{user.username}\0{user.image_url}\0"
+            f"{msg.timestamp.isoformat()}\0{msg.text}").encode()
+    return blake2b(data, digest_size=8).hexdigest()
+
+
+def get_cache():
+    """This app's cache of rendered cards."""
+
+    return current_app.extensions['fragment_cache']
+
+
+def message_card(msg):
+    """HTML of the card for `msg`, from the cache when it's up to date."""
+
+    cache = get_cache()
+    version = card_version(msg)
+
+    entry = cache.get(msg.id)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    html = Markup(render_template('messages/_card.html', msg=msg))
+    cache.set(msg.id, (version, html))
+    return html
+
+
+def invalidate(*message_ids):
+    """Drop the cards of these messages (e.g. when they're deleted)."""
+
+    get_cache().invalidate(*message_ids)
+
+
+def init_app(app):
+    """Give `app` a card cache and the `message_card()` template global."""
+
+    app.extensions['fragment_cache'] = LRUCache(
+        maxsize=app.config.get('FRAGMENT_CACHE_SIZE', 10000))
+    app.jinja_env.globals['message_card'] = message_card
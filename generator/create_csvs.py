@@ -2,15 +2,41 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py                      # the checked-in sizes
+    python generator/create_csvs.py --users 2000000 \\
+        --messages 300000000 --follows 200000000 --out /data/warbler
+
+Output is reproducible: the same --seed and sizes give the same files,
+however many --workers run. Nothing is fetched from the network.
+
+Data is shaped like a real social network rather than uniformly random:
+
+- followers: who gets followed is Zipf-distributed (--follow-skew), so a few
+  users have huge followings and most have a handful
+- following: how many users each person follows is Pareto-distributed
+  (--follows is the expected total)
+- posting: authors are Zipf-distributed too (--post-skew), independently of
+  popularity
+
+Rows are written as they're made. Each file is generated in fixed-size shards
+spread over worker processes, then the shards are stitched together in order.
+The CSVs load with load_data.py.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date, datetime, time
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import Zipf, get_random_datetime, out_degree, scatter, shard_rng
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,7 +48,11 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# rows per shard; fixed so output doesn't depend on the number of workers
+SHARD_ROWS = 200_000
+
+# bcrypt of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +62,192 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images ship with the app, so no lookups are needed
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+# how many names / sentences / cities each shard draws from; combining
+# pooled values is far faster than asking Faker for every row
+FAKER_POOL = 5000
+
+# salts for scatter(), so popularity and activity rank users differently
+FOLLOW_SALT = 7
+POST_SALT = 13
+
+
+def make_faker(seed, kind, shard):
+    fake = Faker()
+    fake.seed_instance(f"{seed}:{kind}:{shard}")
+    return fake
+
+
+def user_rows(args, shard, first, last):
+    """Users with ids first..last."""
+
+    rng = shard_rng(args.seed, 'users', shard)
+    fake = make_faker(args.seed, 'users', shard)
+
+    names = [fake.user_name() for _ in range(FAKER_POOL)]
+    domains = [fake.free_email_domain() for _ in range(20)]
+    bios = [fake.sentence() for _ in range(FAKER_POOL)]
+    cities = [fake.city() for _ in range(FAKER_POOL)]
+
+    for user_id in range(first, last + 1):
+        # the id suffix keeps usernames / emails unique at any scale
+        username = f"{rng.choice(names)}_{user_id}"
+        yield [
+            f"{username}@{rng.choice(domains)}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            rng.choice(bios),
+            rng.choice(header_image_urls),
+            rng.choice(cities),
+        ]
+
+
+def message_rows(args, shard, first, last):
+    """Messages first..last (numbered like their eventual ids)."""
+
+    rng = shard_rng(args.seed, 'messages', shard)
+    fake = make_faker(args.seed, 'messages', shard)
+    sentences = [fake.sentence() for _ in range(FAKER_POOL)]
+
+    authors = Zipf(args.users, args.post_skew, rng)
+    start = datetime.combine(args.start, time.min)
+    end = datetime.combine(args.end, time.min)
+
+    for _ in range(first, last + 1):
+        text = ' '.join(rng.choices(sentences, k=rng.randint(1, 4)))
+        yield [
+            text[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng, start, end),
+            scatter(authors.sample(), args.users, POST_SALT),
+        ]
+
+
+def follow_rows(args, shard, first, last):
+    """Everyone that users first..last follow."""
+
+    rng = shard_rng(args.seed, 'follows', shard)
+    popular = Zipf(args.users, args.follow_skew, rng)
+    mean = args.follows / args.users
+
+    for follower in range(first, last + 1):
+        want = out_degree(rng, mean, args.follow_tail, args.users - 1)
+        followed = set()
+
+        # popular users get drawn again and again; give up rather than spin
+        for _ in range(want * 4):
+            if len(followed) == want:
+                break
+            user_id = scatter(popular.sample(), args.users, FOLLOW_SALT)
+            if user_id != follower:
+                followed.add(user_id)
+
+        for user_id in sorted(followed):
+            yield [user_id, follower]
+
+
+FILES = {
+    'users': (USERS_CSV_HEADERS, user_rows),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows),
+}
+
+
+def shard_size(args, kind):
+    """Users / messages per shard, aiming at about SHARD_ROWS rows each."""
+
+    if kind == 'follows':
+        # sharded by follower, each of whom makes several rows
+        return max(1, SHARD_ROWS * args.users // max(args.follows, 1))
+    return SHARD_ROWS
+
+
+def write_shard(job):
+    """Write one shard to its own file; returns (path, rows written)."""
+
+    args, kind, shard, first, last, path = job
+    rows = 0
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for row in FILES[kind][1](args, shard, first, last):
+            writer.writerow(row)
+            rows += 1
+
+    return path, rows
+
+
+def generate(args, pool, kind, count):
+    """Write `kind`.csv: shards in parallel, then concatenated in order."""
+
+    headers = FILES[kind][0]
+    out_path = os.path.join(args.out, f"{kind}.csv")
+    size = shard_size(args, kind)
+
+    with tempfile.TemporaryDirectory(dir=args.out) as tmp:
+        jobs = [
+            (args, kind, shard, first, min(first + size - 1, count),
+             os.path.join(tmp, f"{kind}.{shard}.csv"))
+            for shard, first in enumerate(range(1, count + 1, size))
+        ]
+
+        total = 0
+        with open(out_path, 'w', newline='') as out:
+            csv.writer(out).writerow(headers)
+
+            # imap keeps shard order while later shards are still running
+            for path, rows in pool.imap(write_shard, jobs):
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(path)
+                total += rows
+
+    print(f"{out_path}: {total:,} rows", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="expected number of follows")
+    parser.add_argument('--seed', default='warbler',
+                        help="same seed and sizes, same files")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes to generate with")
+    parser.add_argument('--follow-skew', type=float, default=1.1,
+                        help="Zipf exponent of follower counts")
+    parser.add_argument('--follow-tail', type=float, default=2.0,
+                        help="Pareto exponent of how many users each follows")
+    parser.add_argument('--post-skew', type=float, default=1.2,
+                        help="Zipf exponent of messages per author")
+    parser.add_argument('--start', type=date.fromisoformat, default=date(2022, 1, 1),
+                        help="earliest message date")
+    parser.add_argument('--end', type=date.fromisoformat, default=date(2024, 1, 1),
+                        help="latest message date")
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("need at least 2 users")
+    if args.follow_tail <= 1:
+        parser.error("--follow-tail must be above 1")
+
+    os.makedirs(args.out, exist_ok=True)
+
+    with Pool(args.workers) as pool:
+        generate(args, pool, 'users', args.users)
+        generate(args, pool, 'messages', args.messages)
+        # follows are sharded by follower
+        generate(args, pool, 'follows', args.users)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,70 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import math
+from datetime import timedelta
+from random import Random
 
+# a big prime, for scattering ranks over ids
+SCATTER_PRIME = 2_147_483_647
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+def get_random_datetime(rng, start, end):
+    """Random datetime between `start` and `end`, drawn from `rng`."""
 
-    return datetime.fromtimestamp(random_timestamp)
+    span = (end - start).total_seconds()
+    return start + timedelta(seconds=rng.uniform(0, span))
+
+
+class Zipf:
+    """Draws ranks 1..n with P(k) roughly proportional to k ** -s.
+
+    Uses the inverse CDF of the continuous approximation, so a draw is O(1)
+    and nothing of size n is kept in memory.
+    """
+
+    def __init__(self, n, s, rng):
+        self.n = n
+        self.s = s
+        self.rng = rng
+
+        if s != 1:
+            self._top = (n + 1) ** (1 - s) - 1
+
+    def sample(self):
+        u = self.rng.random()
+
+        if self.s == 1:
+            k = (self.n + 1) ** u
+        else:
+            k = (1 + u * self._top) ** (1 / (1 - self.s))
+
+        return min(int(k), self.n)
+
+
+def scatter(rank, n, salt):
+    """Map a rank in 1..n to an id in 1..n, one to one.
+
+    Keeps the most popular users (or most active posters) from all being the
+    lowest ids, and gives follower popularity and posting activity different
+    orderings (pass each a different `salt`).
+    """
+
+    # multiplying by a prime that doesn't divide n (n < 2 ** 31) is a
+    # bijection mod n
+    return ((rank - 1) * SCATTER_PRIME + salt) % n + 1
+
+
+def shard_rng(seed, kind, shard):
+    """Independent, reproducible random stream for one shard of one file."""
+
+    return Random(f"{seed}:{kind}:{shard}")
+
+
+def out_degree(rng, mean, alpha, cap):
+    """How many users someone follows: Pareto-distributed with the given
+    mean, so most follow a few and a handful follow very many."""
+
+    # paretovariate(alpha) has mean alpha / (alpha - 1); rescale to `mean`
+    weight = rng.paretovariate(alpha) * (alpha - 1) / alpha
+    degree = math.floor(mean * weight + rng.random())
+    return min(degree, cap)
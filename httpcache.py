@@ -0,0 +1,92 @@
+"""Conditional GETs and per-route Cache-Control.
+
+Profile, message, follow-list and likes pages used to be sent with
+`no-store`, so browsers and the CDN re-downloaded identical pages. Those
+routes now:
+
+- work out a validator from data that changes whenever the page would (e.g.
+  the user's counters and latest message timestamp), plus who's looking
+- answer `304 Not Modified` without rendering when the client already has
+  that version (`not_modified()`)
+- otherwise render as usual, sending the ETag with the page
+
+`@conditional` marks such a route and sets its Cache-Control policy:
+anonymous views may be kept by shared caches for a short while (varying on
+Cookie), logged-in views are private and revalidated every time. Other
+routes keep `add_header()`'s no-store default.
+
+Pages showing a flashed message are never answered with a 304.
+"""
+
+from functools import wraps
+from hashlib import blake2b
+
+from flask import current_app, g, make_response, request, session
+
+ANONYMOUS_POLICY = 'public, max-age=0, s-maxage=30'
+LOGGED_IN_POLICY = 'private, no-cache'
+
+
+def viewer_state():
+    """What about the viewer changes the page: who they are and what they
+    follow and like (frozenset hashes are cached, so this is cheap)."""
+
+    if not g.get('user'):
+        return None
+
+    return (g.user.id, g.user.username, g.user.image_url,
+            hash(g.following_ids), hash(g.liked_ids))
+
+
+def etag_for(*validators):
+    """ETag for this URL, viewer and `validators`."""
+
+    data = repr((request.full_path, viewer_state(), validators)).encode()
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def not_modified(*validators):
+    """A 304 response if the client's copy is current, else None.
+
+    `validators` must change whenever the page would. The ETag is remembered
+    and sent with the rendered page by `@conditional`.
+    """
+
+    if session.get('_flashes'):
+        return None
+
+    g.etag = etag_for(*validators)
+
+    if request.if_none_match.contains_weak(g.etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(g.etag, weak=True)
+        return resp
+
+    return None
+
+
+def conditional(view=None, anonymous=ANONYMOUS_POLICY, logged_in=LOGGED_IN_POLICY):
+    """Give a route's pages ETags and a Cache-Control policy.
+
+    Use as `@conditional` or `@conditional(anonymous=..., logged_in=...)`.
+    """
+
+    def decorate(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            g.etag = None
+            resp = make_response(view(*args, **kwargs))
+
+            # redirects and errors keep the no-store default
+            if resp.status_code in (200, 304):
+                if g.etag and not resp.get_etag()[0]:
+                    resp.set_etag(g.etag, weak=True)
+                resp.headers['Cache-Control'] = logged_in if g.get('user') else anonymous
+                resp.vary.add('Cookie')
+
+            return resp
+        return wrapped
+
+    if view is not None:
+        return decorate(view)
+    return decorate
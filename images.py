@@ -0,0 +1,406 @@
+"""Local proxy for profile and header images, with resized variants.
+
+Avatars and header images are stored as URLs on other sites. Pages used to
+hot-link them at full size, even for 48px timeline thumbnails. Templates
+now call `image_variant(url, variant)`, which gives a URL on this app:
+
+    /images/<variant>/<key>?src=<original url>
+
+The first request for an image fetches it once, on a background worker, and
+writes the original plus every variant under IMAGE_CACHE_DIR. From then on
+each variant is served from disk with a one-year `immutable` Cache-Control.
+A changed avatar is a new URL, so a new key, so there's nothing to expire.
+
+The key is a hash of the source URL keyed with SECRET_KEY. That stops the
+route from being used as an open proxy for any URL. Changing the secret
+just means images get fetched again.
+
+The URLs themselves still come from users (signup, profile edits), so the
+fetcher only talks to public addresses. Every connection, including each
+redirect, is checked after it is made, by the address actually connected
+to. Loopback, link-local (cloud metadata), private and reserved addresses
+are refused, unless listed in IMAGE_ALLOWED_NETWORKS. Redirects may only go
+to http(s), and environment proxies aren't used.
+
+Images are served from this app's origin, so only JPEG, PNG, GIF and WebP
+are accepted, by declared type and by their first bytes. An SVG or an HTML
+page calling itself an image could run script here. They also go out with
+`nosniff` and a CSP that allows nothing.
+
+If the fetch isn't done within IMAGE_WAIT seconds, or fails, the request
+redirects to the original URL. The fetch keeps going in the background for
+next time. Resizing needs Pillow (in requirements.txt); without it, every
+variant is the original image, still cached and served locally. Local
+images (/static/..., like the default avatar) aren't proxied but go through
+`asset_url()`, so they get the built, fingerprinted copy when there is one.
+
+Settings:
+
+- IMAGE_CACHE_DIR: where to keep images (default: <instance path>/images)
+- IMAGE_WORKERS: fetching threads (default 4)
+- IMAGE_WAIT: seconds a request waits for a fetch (default 2)
+- IMAGE_FETCH_TIMEOUT: seconds allowed per download (default 10)
+- IMAGE_MAX_BYTES: largest image accepted (default 5 MB)
+- IMAGE_ALLOWED_NETWORKS: non-public networks images may still come from,
+  e.g. ['10.1.2.0/24'] for an internal CDN (default none)
+"""
+
+import functools
+import hmac
+import ipaddress
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from hashlib import blake2b
+from http.client import HTTPConnection, HTTPSConnection
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import (HTTPDefaultErrorHandler, HTTPErrorProcessor,
+                            HTTPHandler, HTTPRedirectHandler, HTTPSHandler,
+                            OpenerDirector, Request)
+
+from flask import abort, current_app, redirect, request, send_file, url_for
+
+from assets import asset_url
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# name: (width, height, crop to fill rather than fit inside)
+VARIANTS = {
+    'thumb': (96, 96, True),        # timeline-image, the navbar
+    'avatar': (300, 300, True),     # card-image, profile-avatar
+    'hero': (1600, 600, False),     # card-hero, warbler-hero
+}
+
+ORIGINAL = 'original'
+
+# the only formats fetched and served: (declared type, extension, sniff)
+RASTER_TYPES = [
+    ('image/jpeg', '.jpg', lambda data: data[:3] == b'\xff\xd8\xff'),
+    ('image/png', '.png', lambda data: data[:8] == b'\x89PNG\r\n\x1a\n'),
+    ('image/gif', '.gif', lambda data: data[:6] in (b'GIF87a', b'GIF89a')),
+    ('image/webp', '.webp', lambda data: data[:4] == b'RIFF' and data[8:12] == b'WEBP'),
+]
+RASTER_EXTENSIONS = {ext for _, ext, _ in RASTER_TYPES}
+
+# served images come from our origin, so nothing in one may run or be
+# sniffed into something that can
+IMAGE_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'Content-Security-Policy': "default-src 'none'",
+}
+
+
+class ImageFetchError(Exception):
+    """The source image couldn't be downloaded or isn't an image."""
+
+
+@functools.lru_cache(maxsize=None)
+def pillow():
+    """PIL's (Image, ImageOps), or (None, None) without Pillow.
+
+    Imported on the first resize rather than at startup: it's big, and most
+    processes never resize anything.
+    """
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None, None
+    return Image, ImageOps
+
+
+def resize(data, variant):
+    """(bytes, extension) of `data` resized for `variant`; the original
+    when Pillow isn't installed."""
+
+    Image, ImageOps = pillow()
+    if Image is None:
+        return data, None
+
+    width, height, crop = VARIANTS[variant]
+
+    try:
+        with Image.open(BytesIO(data)) as im:
+            im = ImageOps.exif_transpose(im)
+            if crop:
+                im = ImageOps.fit(im, (width, height))
+            else:
+                im.thumbnail((width, height))
+
+            out = BytesIO()
+            if im.mode in ('RGBA', 'LA', 'P'):
+                im.save(out, 'PNG', optimize=True)
+                return out.getvalue(), '.png'
+
+            im.convert('RGB').save(out, 'JPEG', quality=85,
+                                   optimize=True, progressive=True)
+            return out.getvalue(), '.jpg'
+
+    except (OSError, ValueError) as err:
+        raise ImageFetchError(f"can't resize image: {err}")
+
+
+class ForbiddenAddress(OSError):
+    """The image's host is on a network the proxy won't fetch from."""
+
+
+def is_public(address, allowed=()):
+    """Is `address` (an IP string) one the proxy may fetch from?"""
+
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+
+    if any(ip in network for network in allowed):
+        return True
+    return ip.is_global and not ip.is_multicast
+
+
+class GuardedConnection:
+    """Mixin for http.client connections: hang up on non-public peers.
+
+    Checks the address actually connected to, so a hostname that resolves
+    differently the second time (DNS rebinding) doesn't get through.
+    """
+
+    def __init__(self, *args, allowed=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allowed = allowed
+
+    def connect(self):
+        super().connect()
+        address = self.sock.getpeername()[0]
+        if not is_public(address, self.allowed):
+            self.close()
+            raise ForbiddenAddress(f"{self.host} is {address}, not a public address")
+
+
+class GuardedHTTPConnection(GuardedConnection, HTTPConnection):
+    pass
+
+
+class GuardedHTTPSConnection(GuardedConnection, HTTPSConnection):
+    pass
+
+
+class GuardedHTTPHandler(HTTPHandler):
+    def __init__(self, allowed):
+        super().__init__()
+        self.allowed = allowed
+
+    def http_open(self, req):
+        return self.do_open(functools.partial(GuardedHTTPConnection,
+                                              allowed=self.allowed), req)
+
+
+class GuardedHTTPSHandler(HTTPSHandler):
+    def __init__(self, allowed):
+        super().__init__()
+        self.allowed = allowed
+
+    def https_open(self, req):
+        return self.do_open(functools.partial(GuardedHTTPSConnection,
+                                              allowed=self.allowed),
+                            req, context=self._context)
+
+
+class HTTPOnlyRedirectHandler(HTTPRedirectHandler):
+    """Follow redirects to http(s) URLs only (urllib also allows ftp)."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlparse(newurl).scheme not in ('http', 'https'):
+            raise HTTPError(newurl, code, f"redirect to {newurl} refused",
+                            headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def build_opener(allowed=()):
+    """urllib opener for http(s) to public addresses (and `allowed`) only.
+
+    Put together by hand: `urllib.request.build_opener()` would add ftp,
+    file, data and environment proxy handlers.
+    """
+
+    opener = OpenerDirector()
+    for handler in (GuardedHTTPHandler(allowed), GuardedHTTPSHandler(allowed),
+                    HTTPOnlyRedirectHandler(), HTTPDefaultErrorHandler(),
+                    HTTPErrorProcessor()):
+        opener.add_handler(handler)
+    return opener
+
+
+class ImageProxy:
+    """Fetches source images on a thread pool and keeps them on disk."""
+
+    def __init__(self, directory, secret, workers=4, wait=2,
+                 fetch_timeout=10, max_bytes=5 * 1024 * 1024,
+                 allowed_networks=()):
+        self.directory = directory
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.wait = wait
+        self.fetch_timeout = fetch_timeout
+        self.max_bytes = max_bytes
+        self.opener = build_opener([ipaddress.ip_network(network)
+                                    for network in allowed_networks])
+
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='images')
+        self._lock = threading.Lock()
+        self._fetching = {}
+
+    def key(self, src):
+        """Name of `src` on disk and in URLs."""
+
+        return blake2b(src.encode(), key=self.secret[:64],
+                       digest_size=16).hexdigest()
+
+    def _dir(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def find(self, key, name):
+        """Path of the stored variant / original, or None."""
+
+        try:
+            entries = os.listdir(self._dir(key))
+        except FileNotFoundError:
+            return None
+
+        for entry in entries:
+            stem, ext = os.path.splitext(entry)
+            if stem == name and ext in RASTER_EXTENSIONS:
+                return os.path.join(self._dir(key), entry)
+        return None
+
+    def fetch(self, key, src):
+        """Future for storing `src` and its variants; one per image at a time."""
+
+        with self._lock:
+            future = self._fetching.get(key)
+            if future is None:
+                future = self._pool.submit(self._fetch, key, src)
+                self._fetching[key] = future
+                future.add_done_callback(lambda f: self._done(key))
+            return future
+
+    def _done(self, key):
+        with self._lock:
+            self._fetching.pop(key, None)
+
+    def download(self, src):
+        """(bytes, extension) of the image at `src`."""
+
+        req = Request(src, headers={'User-Agent': 'Warbler image proxy'})
+        try:
+            with self.opener.open(req, timeout=self.fetch_timeout) as resp:
+                content_type = resp.headers.get_content_type()
+                data = resp.read(self.max_bytes + 1)
+        except (OSError, ValueError) as err:
+            raise ImageFetchError(f"can't fetch {src}: {err}")
+
+        if len(data) > self.max_bytes:
+            raise ImageFetchError(f"{src} is over {self.max_bytes} bytes")
+
+        # raster images only: an SVG (or HTML calling itself an image) served
+        # from our origin could run script
+        for declared, ext, sniff in RASTER_TYPES:
+            if sniff(data):
+                if content_type != declared:
+                    break
+                return data, ext
+
+        raise ImageFetchError(f"{src} is {content_type}, not a JPEG, PNG, GIF or WebP")
+
+    def _store(self, key, name, ext, data):
+        """Write a file atomically, so readers never see half of one."""
+
+        directory = self._dir(key)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(directory, name + ext))
+
+    def _fetch(self, key, src):
+        original = self.find(key, ORIGINAL)
+        if original is None:
+            data, ext = self.download(src)
+            self._store(key, ORIGINAL, ext, data)
+        else:
+            ext = os.path.splitext(original)[1]
+            with open(original, 'rb') as f:
+                data = f.read()
+
+        for variant in VARIANTS:
+            if self.find(key, variant) is None:
+                body, variant_ext = resize(data, variant)
+                self._store(key, variant, variant_ext or ext, body)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_proxy():
+    """This app's image proxy."""
+
+    return current_app.extensions['image_proxy']
+
+
+def image_variant(src, variant):
+    """URL of `variant` of the image at `src`, through the proxy."""
+
+    static = current_app.static_url_path + '/'
+    if src and src.startswith(static):
+        return asset_url(src[len(static):])
+
+    if not src or not src.startswith(('http://', 'https://')):
+        return src
+
+    return url_for('image', variant=variant, key=get_proxy().key(src), src=src)
+
+
+def serve_image(variant, key):
+    """Send a stored variant; fetch it first if need be."""
+
+    proxy = get_proxy()
+    src = request.args.get('src', '')
+
+    if variant not in VARIANTS or not hmac.compare_digest(key, proxy.key(src)):
+        abort(404)
+
+    path = proxy.find(key, variant)
+
+    if path is None:
+        try:
+            proxy.fetch(key, src).result(timeout=proxy.wait)
+        except (TimeoutError, ImageFetchError) as err:
+            current_app.logger.info("image proxy: %s", err or "still fetching")
+            return redirect(src)
+        path = proxy.find(key, variant)
+
+    resp = send_file(path, max_age=ONE_YEAR)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    resp.headers.update(IMAGE_HEADERS)
+    return resp
+
+
+def init_app(app):
+    """Give `app` an image proxy, its route and `image_variant()`."""
+
+    app.extensions['image_proxy'] = ImageProxy(
+        app.config.get('IMAGE_CACHE_DIR',
+                       os.path.join(app.instance_path, 'images')),
+        app.config['SECRET_KEY'],
+        workers=app.config.get('IMAGE_WORKERS', 4),
+        wait=app.config.get('IMAGE_WAIT', 2),
+        fetch_timeout=app.config.get('IMAGE_FETCH_TIMEOUT', 10),
+        max_bytes=app.config.get('IMAGE_MAX_BYTES', 5 * 1024 * 1024),
+        allowed_networks=app.config.get('IMAGE_ALLOWED_NETWORKS', ()))
+
+    app.add_url_rule('/images/<variant>/<key>', endpoint='image',
+                     view_func=serve_image)
+    app.jinja_env.globals['image_variant'] = image_variant
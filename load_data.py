@@ -0,0 +1,248 @@
+"""Stream the generator/*.csv dumps into the database.
+
+seed.py used to read each CSV whole and insert it in one transaction, which
+runs out of memory (and time) on production-sized dumps. This loader instead:
+
+- reads each CSV in chunks of --chunk-size rows and commits every chunk
+- uses COPY on PostgreSQL and a batched executemany elsewhere (SQLite)
+- drops secondary indexes, foreign keys (PostgreSQL) and the search indexes
+  before loading, and creates them once at the end
+- prints progress in rows/sec
+- resumes: rows already in a table are skipped, so rerunning after an
+  interruption carries on where it stopped
+
+Users and messages get their ids from their line number in the CSV, which is
+what the other files refer to, so a resumed load keeps them lined up.
+
+Once every file is in, the counters, home timelines and search indexes are
+rebuilt.
+
+    python load_data.py                  # load (or resume) into DATABASE_URL
+    python load_data.py --reset          # drop and recreate the tables first
+    python load_data.py --dir dumps/ --chunk-size 50000
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import func, inspect, select, table
+from sqlalchemy.schema import AddConstraint
+
+from app import create_app
+from models import db, User
+import search
+import timeline
+
+# tables in load order (parents first), and whether each row's id is its
+# line number in the CSV
+FILES = [
+    ('users', True),
+    ('messages', True),
+    ('follows', False),
+    ('likes', False),
+]
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def read_header(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f))
+
+
+def read_chunks(path, chunk_size, skip=0, with_ids=False):
+    """Yield lists of at most `chunk_size` rows from a CSV, after its header
+    and the first `skip` rows. `with_ids` puts the line number first."""
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+
+        rows = islice(enumerate(reader, start=1), skip, None)
+
+        while True:
+            chunk = [[n, *row] if with_ids else row
+                     for n, row in islice(rows, chunk_size)]
+            if not chunk:
+                return
+            yield chunk
+
+
+def copy_rows(conn, table_name, columns, rows):
+    """COPY rows in (PostgreSQL)."""
+
+    buf = io.StringIO()
+    # everything quoted, so empty strings stay '' rather than NULL
+    csv.writer(buf, quoting=csv.QUOTE_ALL).writerows(rows)
+    buf.seek(0)
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf)
+
+
+def insert_rows(conn, table_name, columns, rows):
+    """INSERT rows in with one executemany."""
+
+    marker = '?' if conn.dialect.paramstyle == 'qmark' else '%s'
+    conn.exec_driver_sql(
+        f"INSERT INTO {table_name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join([marker] * len(columns))})",
+        [tuple(row) for row in rows])
+
+
+def drop_indexes(conn):
+    """Drop everything a bulk load would otherwise maintain row by row."""
+
+    search.uninstall(conn)
+
+    for tbl in db.metadata.sorted_tables:
+        for index in tbl.indexes:
+            index.drop(conn, checkfirst=True)
+
+    # SQLite can't drop constraints (and doesn't enforce foreign keys unless
+    # asked to), so only PostgreSQL loses its foreign keys
+    if conn.dialect.name == 'postgresql':
+        inspector = inspect(conn)
+        for tbl in db.metadata.sorted_tables:
+            for fk in inspector.get_foreign_keys(tbl.name):
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {tbl.name} DROP CONSTRAINT {fk['name']}")
+
+
+def create_indexes(conn):
+    """Put back whatever `drop_indexes()` dropped."""
+
+    if conn.dialect.name == 'postgresql':
+        inspector = inspect(conn)
+        for tbl in db.metadata.sorted_tables:
+            existing = {(tuple(fk['constrained_columns']), fk['referred_table'])
+                        for fk in inspector.get_foreign_keys(tbl.name)}
+            for fk in tbl.foreign_key_constraints:
+                key = (tuple(fk.column_keys), fk.referred_table.name)
+                if key not in existing:
+                    conn.execute(AddConstraint(fk))
+
+    for tbl in db.metadata.sorted_tables:
+        for index in tbl.indexes:
+            index.create(conn, checkfirst=True)
+
+    search.install(conn)
+
+
+def load_file(path, table_name, with_ids, chunk_size):
+    """Load one CSV, skipping rows a previous run already loaded."""
+
+    engine = db.engine
+    columns = read_header(path)
+    if with_ids:
+        columns = ['id'] + columns
+
+    # the CSVs have no created_at (follows), so stamp rows as they load. The
+    # server default would do, but SQLite's CURRENT_TIMESTAMP has no
+    # fraction of a second, and those strings sort apart from the ones
+    # SQLAlchemy writes and binds (pagination cursors).
+    stamp = ('created_at' in db.metadata.tables[table_name].c
+             and 'created_at' not in columns)
+    if stamp:
+        columns = columns + ['created_at']
+
+    with engine.connect() as conn:
+        done = conn.scalar(select(func.count()).select_from(table(table_name)))
+
+    if done:
+        print(f"{table_name}: resuming after {done:,} rows", file=sys.stderr)
+
+    load_rows = (copy_rows if engine.dialect.name == 'postgresql'
+                 else insert_rows)
+
+    started = time.monotonic()
+    loaded = 0
+
+    for chunk in read_chunks(path, chunk_size, skip=done, with_ids=with_ids):
+        if stamp:
+            now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+            chunk = [row + [now] for row in chunk]
+
+        # one transaction per chunk, so an interrupted load only loses the
+        # chunk in flight
+        with engine.begin() as conn:
+            load_rows(conn, table_name, columns, chunk)
+
+        loaded += len(chunk)
+        rate = loaded / max(time.monotonic() - started, 1e-9)
+        print(f"{table_name}: {done + loaded:,} rows ({rate:,.0f} rows/sec)",
+              file=sys.stderr)
+
+    return loaded
+
+
+def finalize():
+    """Rebuild everything the raw inserts skipped."""
+
+    engine = db.engine
+
+    with engine.begin() as conn:
+        print("creating indexes", file=sys.stderr)
+        create_indexes(conn)
+
+        # ids were given explicitly, so move the sequences past them
+        if conn.dialect.name == 'postgresql':
+            for table_name, with_ids in FILES:
+                if with_ids:
+                    conn.exec_driver_sql(
+                        f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+                        f"COALESCE((SELECT max(id) FROM {table_name}), 0) + 1, false)")
+
+    print("reconciling counters and rebuilding timelines", file=sys.stderr)
+    User.reconcile_counts()
+    timeline.rebuild()
+    db.session.commit()
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql("ANALYZE")
+
+
+def load(directory='generator', chunk_size=DEFAULT_CHUNK_SIZE, reset=False):
+    """Load every CSV in `directory` that matches a table, then finalize."""
+
+    if reset:
+        db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        drop_indexes(conn)
+
+    for table_name, with_ids in FILES:
+        path = os.path.join(directory, f"{table_name}.csv")
+        if os.path.exists(path):
+            load_file(path, table_name, with_ids, chunk_size)
+
+    finalize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding users.csv etc. (default: generator)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"rows per transaction (default: {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument('--reset', action='store_true',
+                        help="drop and recreate the tables first (no resume)")
+    args = parser.parse_args()
+
+    # bulk loads and index builds run as long as they need to
+    with create_app(DB_STATEMENT_TIMEOUT_MS=None).app_context():
+        load(args.dir, args.chunk_size, args.reset)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Loader options for the list pages.
+
+A list page should run a fixed number of queries however long the list is,
+and load only the columns its template shows. The queries behind the
+likes, search and single-message pages apply these (the feeds and plain
+user lists load rows instead; see projections.py):
+
+- `message_cards()`: messages shown with `message_card()`, each with its
+  author's id, username and image_url joined into the same query
+- `user_cards()`: users shown as cards (users/index.html): the card's
+  columns only
+
+With RAISE_ON_LAZY_LOAD set (the development and test profiles), objects
+loaded this way also raise when code touches a relationship that would need
+another query. A new N+1 in a template then fails on the first page view
+instead of slowing production down. Relationships already in the session
+(e.g. a message's author who is also the profile being shown) still load
+without SQL.
+"""
+
+from flask import current_app, has_app_context
+from sqlalchemy.orm import joinedload, load_only, raiseload
+
+from models import Message, User
+
+
+def strict(*options):
+    """`options`, plus raiseload for everything else when
+    RAISE_ON_LAZY_LOAD is set."""
+
+    if has_app_context() and current_app.config.get('RAISE_ON_LAZY_LOAD'):
+        return options + (raiseload('*', sql_only=True),)
+    return options
+
+
+def message_cards():
+    """Options for loading messages shown as cards."""
+
+    return strict(joinedload(Message.user).load_only(User.username, User.image_url))
+
+
+def user_cards():
+    """Options for loading users shown as cards."""
+
+    return strict(load_only(User.username, User.image_url,
+                            User.header_image_url, User.bio))
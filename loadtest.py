@@ -0,0 +1,320 @@
+"""Load-test a running Warbler and report latency per route.
+
+Many concurrent clients each log in as a different seeded user (from
+generator/users.csv; every seeded password is "password") and then replay a
+weighted mix of requests until the time is up:
+
+- home: GET /
+- users_show: GET /users/<id>
+- users_search: GET /users?q=<part of a username>
+- messages_add: POST /messages/new
+- follow: POST /users/follow/<id>, or stop-following if already following
+- like: PUT / DELETE /api/messages/<id>/like
+
+Prints JSON with throughput, p50/p95/p99 latency and error rate per route
+(and overall), to compare builds:
+
+    python loadtest.py --url http://localhost:5000 --clients 50 --duration 60
+    python loadtest.py --mix home=70,users_show=20,like=10 --out before.json
+
+Redirects aren't followed, so a write is timed without the page it redirects
+to. Start the app against a database seeded from the same CSVs (seed.py or
+load_data.py) so ids line up.
+"""
+
+import argparse
+import csv
+import json
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from http.cookiejar import CookieJar
+from random import Random
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+DEFAULT_MIX = 'home=50,users_show=20,users_search=10,messages_add=5,follow=10,like=5'
+
+PASSWORD = 'password'
+
+# logging in happens once per client; it's reported but kept out of the total
+SETUP_ROUTES = {'login_form', 'login'}
+
+CSRF_INPUT = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """Report redirects as responses instead of following them."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Stats:
+    """Latencies and status codes per route, shared by every client."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, status):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            self.statuses[route][str(status)] += 1
+            if status is None or status >= 400:
+                self.errors[route] += 1
+
+    def summary(self, elapsed):
+        routes = {route: summarize(times, self.errors[route], elapsed,
+                                   self.statuses[route])
+                  for route, times in sorted(self.latencies.items())}
+
+        every = [t for route, times in self.latencies.items()
+                 if route not in SETUP_ROUTES for t in times]
+        errors = sum(n for route, n in self.errors.items()
+                     if route not in SETUP_ROUTES)
+
+        return {'total': summarize(every, errors, elapsed), 'routes': routes}
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not ordered:
+        return None
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(times, errors, elapsed, statuses=None):
+    ordered = sorted(times)
+    ms = lambda s: None if s is None else round(s * 1000, 2)
+
+    summary = {
+        'requests': len(ordered),
+        'errors': errors,
+        'error_rate': round(errors / len(ordered), 4) if ordered else 0,
+        'rps': round(len(ordered) / elapsed, 2) if elapsed else None,
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+        'max_ms': ms(ordered[-1] if ordered else None),
+    }
+    if statuses is not None:
+        summary['statuses'] = dict(statuses)
+    return summary
+
+
+def parse_mix(value):
+    """'home=50,like=5' -> {'home': 50, 'like': 5}"""
+
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown route {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def read_users(path, limit):
+    """(id, username) of up to `limit` users; ids are CSV line numbers."""
+
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        return [(n, row['username'])
+                for n, row in zip(range(1, limit + 1), reader)]
+
+
+def count_rows(path):
+    try:
+        with open(path, newline='') as f:
+            return max(sum(1 for _ in f) - 1, 0)
+    except FileNotFoundError:
+        return 0
+
+
+class Client:
+    """One simulated user with their own cookies."""
+
+    def __init__(self, base_url, stats, rng, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.rng = rng
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect())
+        self.csrf_token = None
+        self.user_id = None
+        self.following = set()
+        self.liked = set()
+
+    def request(self, route, path, method='GET', data=None):
+        """Time one request; returns (status, body) and records it."""
+
+        body = urlencode(data).encode() if data is not None else None
+        req = Request(self.base_url + path, data=body, method=method)
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                status, text = resp.status, resp.read().decode('utf-8', 'replace')
+        except HTTPError as err:
+            status, text = err.code, ''
+        except (URLError, OSError):
+            status, text = None, ''
+
+        self.stats.record(route, time.perf_counter() - started, status)
+        return status, text
+
+    def login(self, user_id, username):
+        self.user_id = user_id
+        _, page = self.request('login_form', '/login')
+        match = CSRF_INPUT.search(page)
+        self.csrf_token = match and match.group(1)
+
+        status, _ = self.request('login', '/login', 'POST', {
+            'csrf_token': self.csrf_token or '',
+            'username': username,
+            'password': PASSWORD,
+        })
+        return status == 302
+
+
+def do_home(client, env):
+    client.request('home', '/')
+
+
+def do_users_show(client, env):
+    user_id, _ = client.rng.choice(env['users'])
+    client.request('users_show', f'/users/{user_id}')
+
+
+def do_users_search(client, env):
+    _, username = client.rng.choice(env['users'])
+    term = username[:client.rng.randint(3, 6)]
+    client.request('users_search', '/users?' + urlencode({'q': term}))
+
+
+def do_messages_add(client, env):
+    client.request('messages_add', '/messages/new', 'POST', {
+        'csrf_token': client.csrf_token or '',
+        'text': f"load test warble {client.rng.random():.8f}",
+    })
+
+
+def do_follow(client, env):
+    user_id = client.rng.randint(1, env['num_users'])
+
+    # the app ignores follows of yourself, so there'd be nothing to undo
+    if user_id == client.user_id:
+        return
+
+    if user_id in client.following:
+        client.request('follow', f'/users/stop-following/{user_id}', 'POST', {})
+        client.following.discard(user_id)
+    else:
+        client.request('follow', f'/users/follow/{user_id}', 'POST', {})
+        client.following.add(user_id)
+
+
+def do_like(client, env):
+    if not env['num_messages']:
+        return
+    message_id = client.rng.randint(1, env['num_messages'])
+    method = 'DELETE' if message_id in client.liked else 'PUT'
+
+    status, _ = client.request('like', f'/api/messages/{message_id}/like', method)
+    if status == 200:
+        client.liked.symmetric_difference_update({message_id})
+
+
+ACTIONS = {
+    'home': do_home,
+    'users_show': do_users_show,
+    'users_search': do_users_search,
+    'messages_add': do_messages_add,
+    'follow': do_follow,
+    'like': do_like,
+}
+
+
+def run_client(n, args, env, stats, deadline):
+    rng = Random(f"{args.seed}:{n}")
+    client = Client(args.url, stats, rng, args.timeout)
+
+    user_id, username = env['users'][n % len(env['users'])]
+    if not client.login(user_id, username):
+        print(f"client {n}: login as {username} failed", file=sys.stderr)
+        return
+
+    names = list(args.mix)
+    weights = list(args.mix.values())
+
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        ACTIONS[name](client, env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000',
+                        help="Warbler to test (default: http://localhost:5000)")
+    parser.add_argument('--clients', type=int, default=20,
+                        help="concurrent clients, each its own user (default: 20)")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to run for (default: 30)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"route weights (default: {DEFAULT_MIX})")
+    parser.add_argument('--users-csv', default='generator/users.csv')
+    parser.add_argument('--messages-csv', default='generator/messages.csv',
+                        help="only counted, to pick message ids to like")
+    parser.add_argument('--max-users', type=int, default=100000,
+                        help="read at most this many users from the CSV")
+    parser.add_argument('--timeout', type=float, default=30,
+                        help="per-request timeout in seconds")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--out', help="write the JSON report here too")
+    args = parser.parse_args()
+
+    users = read_users(args.users_csv, args.max_users)
+    env = {
+        'users': users,
+        'num_users': len(users),
+        'num_messages': count_rows(args.messages_csv),
+    }
+
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + args.duration
+
+    threads = [threading.Thread(target=run_client,
+                                args=(n, args, env, stats, deadline),
+                                daemon=True)
+               for n in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = {
+        'url': args.url,
+        'clients': args.clients,
+        'duration_s': round(time.monotonic() - started, 2),
+        'mix': args.mix,
+        **stats.summary(time.monotonic() - started),
+    }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Bring an existing Warbler database up to date with models.py.
+
+`db.create_all()` only creates missing tables, so databases created before a
+column or index was added to the models never get it. This script adds, in
+order:
+
+- any missing tables
+- any missing columns (ALTER TABLE ... ADD COLUMN)
+- any missing indexes (CREATE INDEX CONCURRENTLY on PostgreSQL, so building an
+  index on a big table doesn't block writes), rebuilding any whose uniqueness
+  changed
+- drops unique constraints the models no longer declare (on SQLite, by
+  rebuilding the table)
+- the search indexes from search.py, which aren't plain model indexes
+
+Everything is checked first, so it is safe to run repeatedly. New counter
+columns start at zero and new tables start empty, so follow a migration with
+`flask reconcile-counts` and `flask rebuild-timelines`.
+
+    python migrate.py            # apply
+    python migrate.py --dry-run  # only print the SQL
+"""
+
+import re
+import sys
+from datetime import datetime
+
+from sqlalchemy import UniqueConstraint, inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+
+from app import create_app
+from models import db
+import search
+
+
+def pending_statements(engine):
+    """SQL needed to bring `engine`'s database up to date, as strings."""
+
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    statements = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            # created (with its indexes) by create_all below
+            continue
+
+        columns = {col['name'] for col in inspector.get_columns(table.name)}
+
+        # unique constraints the models no longer have (e.g. likes.message_id
+        # used to be unique, so only one user could like a message)
+        wanted = {tuple(col.name for col in con.columns)
+                  for con in table.constraints
+                  if isinstance(con, UniqueConstraint)}
+        unwanted = [con for con in inspector.get_unique_constraints(table.name)
+                    if tuple(con['column_names']) not in wanted]
+
+        # SQLite can't drop a constraint, so the table is
+        # rebuilt from the model instead, with its columns and indexes
+        if unwanted and engine.dialect.name == 'sqlite':
+            statements += rebuild_sqlite_table(table, columns, engine.dialect)
+            continue
+
+        for con in unwanted:
+            if con['name'] and engine.dialect.name == 'postgresql':
+                statements.append(
+                    f"ALTER TABLE {table.name} DROP CONSTRAINT {con['name']}")
+
+        for column in table.columns:
+            if column.name not in columns:
+                spec = str(CreateColumn(column).compile(dialect=engine.dialect))
+                if engine.dialect.name == 'sqlite':
+                    spec = constant_default(spec)
+                statements.append(f"ALTER TABLE {table.name} ADD COLUMN {spec}")
+
+
+        indexes = {ix['name']: ix for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            existing = indexes.get(index.name)
+
+            # an index that became unique (or stopped being) is rebuilt
+            if existing is not None and bool(existing['unique']) != bool(index.unique):
+                sql = f"DROP INDEX {index.name}"
+                if engine.dialect.name == 'postgresql':
+                    sql = sql.replace('DROP INDEX', 'DROP INDEX CONCURRENTLY', 1)
+                statements.append(sql)
+                existing = None
+
+            if existing is None:
+                sql = str(CreateIndex(index).compile(dialect=engine.dialect))
+                if engine.dialect.name == 'postgresql':
+                    sql = re.sub(r'^CREATE (UNIQUE )?INDEX',
+                                 r'CREATE \1INDEX CONCURRENTLY', sql)
+                statements.append(sql)
+
+    return statements
+
+
+def rebuild_sqlite_table(table, existing_columns, dialect):
+    """Statements rebuilding SQLite table `table` to match the model.
+
+    The way SQLite's docs describe for changes ALTER TABLE can't make: create
+    the new table, copy the rows over, drop the old one and rename the new
+    one into place, then recreate the indexes. All in one transaction.
+    """
+
+    new_name = f"{table.name}__new"
+    create = str(CreateTable(table).compile(dialect=dialect)).strip()
+    create = re.sub(rf'^CREATE TABLE {table.name}\b', f'CREATE TABLE {new_name}', create)
+    copied = ', '.join(col.name for col in table.columns
+                       if col.name in existing_columns)
+
+    return ['BEGIN',
+            create,
+            f"INSERT INTO {new_name} ({copied}) SELECT {copied} FROM {table.name}",
+            f"DROP TABLE {table.name}",
+            f"ALTER TABLE {new_name} RENAME TO {table.name}",
+            *[str(CreateIndex(index).compile(dialect=dialect))
+              for index in table.indexes],
+            'COMMIT']
+
+
+def constant_default(spec):
+    """SQLite column spec `spec` with a default like (CURRENT_TIMESTAMP)
+    swapped for the current time.
+
+    SQLite only adds columns with constant defaults, so existing rows (e.g.
+    follows from before follows.created_at) get the time of the migration.
+    PostgreSQL fills them with now() itself.
+    """
+
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    return re.sub(r"DEFAULT \((CURRENT_TIMESTAMP|CURRENT_DATE|CURRENT_TIME)\)",
+                  f"DEFAULT '{now}'", spec)
+
+
+def missing_tables(engine):
+    """Names of model tables that don't exist yet."""
+
+    existing = set(inspect(engine).get_table_names())
+    return [t.name for t in db.metadata.sorted_tables if t.name not in existing]
+
+
+def migrate(dry_run=False):
+    engine = db.engine
+
+    for name in missing_tables(engine):
+        print(f"-- create table {name}")
+    if not dry_run:
+        db.create_all()
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for sql in pending_statements(engine):
+            print(f"{sql};")
+            if not dry_run:
+                conn.exec_driver_sql(sql)
+
+        print("-- install search indexes")
+        if not dry_run:
+            search.install(conn)
+
+
+if __name__ == '__main__':
+    # index builds run as long as they need to
+    with create_app(DB_STATEMENT_TIMEOUT_MS=None).app_context():
+        migrate(dry_run='--dry-run' in sys.argv[1:])
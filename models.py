@@ -2,11 +2,12 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import get_hasher
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class Follows(db.Model):
@@ -26,6 +27,25 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # when the follow happened; the follow pages list newest first. The
+    # server default covers bulk loads and rows that predate the column.
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # the PK leads with the followed user, so "who does X follow?" needs its own;
+    # the follow pages page through each side by (created_at, other user)
+    __table_args__ = (
+        db.Index('ix_follows_following', 'user_following_id', 'user_being_followed_id'),
+        db.Index('ix_follows_following_created',
+                 user_following_id, created_at.desc(), user_being_followed_id.desc()),
+        db.Index('ix_follows_followed_created',
+                 user_being_followed_id, created_at.desc(), user_following_id.desc()),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +65,79 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True
     )
 
+    __table_args__ = (
+        # one like per user per message; also the ON CONFLICT target below
+        db.Index('ix_likes_user', 'user_id', 'message_id', unique=True),
+    )
+
+    @classmethod
+    def _insert(cls):
+        """INSERT for this database's dialect, for ON CONFLICT support."""
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        return insert(cls)
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like a message in one statement. Returns False if already liked
+        (or if there's no such message)."""
+
+        stmt = (cls._insert()
+                .from_select(['user_id', 'message_id'],
+                             db.select(db.literal(user_id), Message.id)
+                             .where(Message.id == message_id))
+                .on_conflict_do_nothing(index_elements=['user_id', 'message_id']))
+
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike a message in one statement. Returns False if not liked."""
+
+        stmt = db.delete(cls).where(cls.user_id == user_id,
+                                    cls.message_id == message_id)
+
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove_for_messages(cls, message_ids):
+        """Delete every like of the messages in `message_ids` (a list or a
+        SELECT of ids), and take each off its liker's likes_count.
+
+        Run before deleting the messages. PostgreSQL's ON DELETE CASCADE would
+        drop the likes without touching the counters, and SQLite (foreign keys
+        not enforced) would leave them behind.
+        """
+
+        of_messages = cls.message_id.in_(message_ids)
+        per_liker = (db.select(db.func.count())
+                     .select_from(cls)
+                     .where(cls.user_id == User.id, of_messages)
+                     .scalar_subquery())
+
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(db.select(cls.user_id).where(of_messages)))
+            .values({User.likes_count: User.likes_count - per_liker}),
+            execution_options={'synchronize_session': False})
+        db.session.execute(db.delete(cls).where(of_messages),
+                           execution_options={'synchronize_session': False})
+
+    @classmethod
+    def count_for(cls, message_id):
+        """How many users like this message."""
+
+        return db.session.scalar(db.select(db.func.count())
+                                 .select_from(cls)
+                                 .where(cls.message_id == message_id))
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +184,47 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counters, kept in step by the routes that change them;
+    # `User.reconcile_counts()` recomputes them if they ever drift
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set for good once an author posts, or is followed, with
+    # TIMELINE_FANOUT_LIMIT followers (see timeline.py), so losing followers
+    # can't hide what wasn't fanned out
+    fanout_on_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -115,20 +246,108 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # the user directory, most followed first; and the few fan-out-on-read
+    # authors, which every homepage checks the viewer's follows against
+    __table_args__ = (
+        db.Index('ix_users_followers', followers_count.desc(), id.desc()),
+        db.Index('ix_users_fanout_on_read', id,
+                 postgresql_where=fanout_on_read, sqlite_where=fanout_on_read),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.scalar(db.select(db.exists().where(
+            Follows.user_following_id == other_user.id,
+            Follows.user_being_followed_id == self.id)))
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.scalar(db.select(db.exists().where(
+            Follows.user_following_id == self.id,
+            Follows.user_being_followed_id == other_user.id)))
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        return db.session.scalar(db.select(db.exists().where(
+            Likes.user_id == self.id,
+            Likes.message_id == message.id)))
+
+    def follow_and_like_ids(self, user_ids=None, message_ids=None):
+        """(ids of users followed, ids of messages liked) by this user.
+
+        Both come back from one query. Pass `user_ids` / `message_ids` to
+        only ask about those, e.g. the users or messages on one page.
+        """
+
+        follows = (db.select(db.literal('f').label('kind'),
+                             Follows.user_being_followed_id.label('id'))
+                   .where(Follows.user_following_id == self.id))
+        likes = (db.select(db.literal('l').label('kind'),
+                           Likes.message_id.label('id'))
+                 .where(Likes.user_id == self.id))
+
+        if user_ids is not None:
+            follows = follows.where(
+                Follows.user_being_followed_id.in_(list(user_ids)))
+        if message_ids is not None:
+            likes = likes.where(Likes.message_id.in_(list(message_ids)))
+
+        rows = db.session.execute(db.union_all(follows, likes)).all()
+
+        following_ids = frozenset(id for kind, id in rows if kind == 'f')
+        liked_ids = frozenset(id for kind, id in rows if kind == 'l')
+        return following_ids, liked_ids
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Add to this user's counter columns in a single UPDATE.
+
+        e.g. `User.adjust_counts(user.id, likes_count=1)`. Runs in the
+        caller's transaction, so the counter commits with the change it counts.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        cls.query.filter(cls.id == user_id).update(values)
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the source tables.
+
+        Only rows that have drifted are rewritten. Returns how many were fixed.
+        """
+
+        actual = {
+            cls.messages_count: (db.select(db.func.count(Message.id))
+                                 .where(Message.user_id == cls.id)
+                                 .scalar_subquery()),
+            cls.following_count: (db.select(db.func.count())
+                                  .select_from(Follows)
+                                  .where(Follows.user_following_id == cls.id)
+                                  .scalar_subquery()),
+            cls.followers_count: (db.select(db.func.count())
+                                  .select_from(Follows)
+                                  .where(Follows.user_being_followed_id == cls.id)
+                                  .scalar_subquery()),
+            # likes of messages that are gone don't count (SQLite leaves them)
+            cls.likes_count: (db.select(db.func.count(Likes.id))
+                              .join(Message, Message.id == Likes.message_id)
+                              .where(Likes.user_id == cls.id)
+                              .scalar_subquery()),
+        }
+
+        drifted = db.or_(*[col != count for col, count in actual.items()])
+        result = db.session.execute(
+            db.update(cls).where(drifted).values(actual),
+            execution_options={'synchronize_session': False})
+
+        return result.rowcount
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +356,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = get_hasher().hash(password)
 
         user = User(
             username=username,
@@ -162,13 +381,28 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's?
+
+        On a match, a hash made with an outdated bcrypt cost is replaced with
+        one at the configured cost; the caller commits.
+        """
+
+        hasher = get_hasher()
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -199,6 +433,53 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # a user's messages, newest first (profile feed, timeline backfill)
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp',
+                 user_id, timestamp.desc(), id.desc()),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline (their "inbox").
+
+    Rows are written when a message is posted (fan-out-on-write), so the
+    homepage can read a user's feed with one range scan on
+    (owner_id, timestamp) instead of joining through follows.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # copied from the message so the feed can be ordered without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_owner_timestamp',
+                 'owner_id', timestamp.desc(), message_id.desc()),
+        db.Index('ix_timeline_owner_author', 'owner_id', 'author_id'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,172 @@
+"""Keyset (cursor) pagination helpers.
+
+Feeds are ordered newest-first on (timestamp, id). Instead of OFFSET, a page
+remembers the sort key of its first and last rows as opaque cursors:
+
+- `?before=<cursor>` asks for the next page of older rows
+- `?after=<cursor>` asks for the previous page of newer rows
+
+Each page is then a range scan that starts at the cursor, so page 1,000 costs
+the same as page 1. The id tie-break keeps ordering stable when many rows share
+a timestamp.
+
+Lists sorted ascending (e.g. search results by rank) work the same way with
+`descending=False`: `before` still means "the next page", `after` "the
+previous one".
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    """A cursor that wasn't produced by `encode_cursor`."""
+
+
+class Page:
+    """One page of results plus cursors to its neighbours.
+
+    `newer` / `older` are None when there is nothing in that direction.
+    """
+
+    def __init__(self, items, newer=None, older=None):
+        self.items = items
+        self.newer = newer
+        self.older = older
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(*values):
+    """Pack sort-key values (datetimes, numbers, strings) into a URL-safe token."""
+
+    packed = [{'dt': v.isoformat()} if isinstance(v, datetime) else v
+              for v in values]
+    raw = json.dumps(packed, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(token):
+    """Unpack a token from `encode_cursor` into a list of values."""
+
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        packed = json.loads(raw)
+        if not isinstance(packed, list):
+            raise InvalidCursor(token)
+        return [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v
+                for v in packed]
+    except (binascii.Error, ValueError, KeyError, TypeError, UnicodeDecodeError):
+        raise InvalidCursor(token)
+
+
+# sort-key value types, for `page_args()`
+FEED_KEY = (datetime, int)          # (timestamp, id)
+COUNT_KEY = (int, int)              # (a count or rank, id)
+SCORE_KEY = ((int, float), int)     # (a search score, id)
+
+
+def cursor_fits(cursor, types):
+    """Do `cursor`'s values have `types` (one type or tuple per value)?"""
+
+    return len(cursor) == len(types) and all(
+        isinstance(value, kind) and not isinstance(value, bool)
+        for value, kind in zip(cursor, types))
+
+
+def page_args(types=FEED_KEY):
+    """Read `before`, `after` and `limit` from the querystring.
+
+    Responds 400 on a malformed cursor, or one whose values don't have the
+    sort key's `types` (a cursor from another list would otherwise reach the
+    database as the wrong type). `limit` is clamped to FEED_MAX_PAGE_SIZE and
+    defaults to FEED_PAGE_SIZE.
+    """
+
+    default = current_app.config.get('FEED_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    most = current_app.config.get('FEED_MAX_PAGE_SIZE', DEFAULT_MAX_PAGE_SIZE)
+    limit = min(max(request.args.get('limit', default, type=int), 1), most)
+
+    try:
+        before = request.args.get('before')
+        after = request.args.get('after')
+        before = decode_cursor(before) if before else None
+        after = decode_cursor(after) if after else None
+    except InvalidCursor:
+        abort(400)
+
+    if any(c is not None and not cursor_fits(c, types) for c in (before, after)):
+        abort(400)
+
+    return before, after, limit
+
+
+def keyset(stmt, columns, before=None, after=None, limit=DEFAULT_PAGE_SIZE,
+           descending=True):
+    """Restrict a query/select to one page past a cursor, ordered on `columns`.
+
+    Fetches one extra row so `make_page` can tell whether more rows exist.
+    With `after`, rows come back in reverse order; `make_page` flips them.
+    """
+
+    key = tuple_(*columns)
+    cursor = after if after is not None else before
+
+    # walking back towards the start of the list flips the sort
+    desc = descending if after is None else not descending
+
+    if cursor is not None:
+        stmt = stmt.filter(key < tuple_(*cursor) if desc else key > tuple_(*cursor))
+
+    stmt = stmt.order_by(*[col.desc() if desc else col.asc() for col in columns])
+
+    return stmt.limit(limit + 1)
+
+
+def make_page(rows, sort_key, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Build a `Page` from rows fetched by `keyset`.
+
+    `sort_key(row)` returns the tuple of values the rows are ordered on.
+    """
+
+    rows = list(rows)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if after is not None:
+        rows.reverse()
+
+    if not rows:
+        return Page(rows)
+
+    has_newer = more if after is not None else before is not None
+    has_older = True if after is not None else more
+
+    return Page(
+        rows,
+        newer=encode_cursor(*sort_key(rows[0])) if has_newer else None,
+        older=encode_cursor(*sort_key(rows[-1])) if has_older else None,
+    )
+
+
+def page_url(**cursor):
+    """URL of the current page with its cursor swapped for `cursor`.
+
+    Other querystring args (search terms, limit) are kept.
+    """
+
+    args = {k: v for k, v in request.args.items() if k not in ('before', 'after')}
+    args.update(cursor)
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
@@ -0,0 +1,100 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow. Run inline, a burst of logins ties up every
+request thread and stalls unrelated page views. Hashing and checking instead
+run on a small thread pool (bcrypt releases the GIL while it works), and a
+request that finds the pool and its queue full fails fast with
+`PasswordPoolBusy` rather than waiting in line.
+
+The bcrypt cost is configurable. Hashes made with a different cost are
+upgraded on the next successful login, so the cost can be tuned without
+making everyone reset their password.
+
+Settings:
+
+- BCRYPT_LOG_ROUNDS: bcrypt work factor (default 12)
+- PASSWORD_WORKERS: hashing threads (default 4)
+- PASSWORD_QUEUE_DEPTH: jobs allowed to wait for a thread (default 16)
+- PASSWORD_TIMEOUT: seconds to wait for a result (default 10)
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password operations are already queued; try again later."""
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing / checking on a bounded pool of threads."""
+
+    def __init__(self, rounds=12, workers=4, queue_depth=16, timeout=10):
+        self.rounds = rounds
+        self.timeout = timeout
+
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='bcrypt')
+        # one slot per running or waiting job
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordPoolBusy()
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost, as a str."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        # $2b$<cost>$<salt+hash>
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+def get_hasher():
+    """This app's `PasswordHasher`."""
+
+    return current_app.extensions['password_hasher']
+
+
+def init_app(app):
+    """Give `app` a password hashing pool sized from its config."""
+
+    app.extensions['password_hasher'] = PasswordHasher(
+        rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        workers=app.config.get('PASSWORD_WORKERS', 4),
+        queue_depth=app.config.get('PASSWORD_QUEUE_DEPTH', 16),
+        timeout=app.config.get('PASSWORD_TIMEOUT', 10))
@@ -0,0 +1,152 @@
+"""Database connection pool settings, timeouts and metrics.
+
+Flask-SQLAlchemy's defaults give an unbounded wait for a connection (30s),
+no health check and no limit on how long a statement may run. Under load,
+that means connection storms and requests that hang on a bad query. Here:
+
+- pool size, overflow, checkout timeout, recycle time and pre-ping come from
+  the config
+- on PostgreSQL every connection gets a `statement_timeout`, so a runaway
+  query is cancelled instead of holding a worker and a connection
+- the pool records how long each checkout waited, how full the pool was and
+  how many checkouts timed out (`/_stats/db-pool` in app.py)
+- a request that can't get a connection within DB_POOL_TIMEOUT fails with a
+  quick 503 rather than queueing behind everyone else
+
+Settings (applied to the primary and every replica):
+
+- DB_POOL_SIZE: connections kept open per process (default 5)
+- DB_MAX_OVERFLOW: extra connections allowed under load (default 10)
+- DB_POOL_TIMEOUT: seconds to wait for a connection (default 2)
+- DB_POOL_RECYCLE: seconds before a connection is replaced (default 1800)
+- DB_POOL_PRE_PING: check connections before use (default True)
+- DB_STATEMENT_TIMEOUT_MS: PostgreSQL statement_timeout, or None for none
+  (default None; 5000 in the production profile)
+
+Long maintenance jobs call `lift_statement_timeout()` first.
+"""
+
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# checkout waits kept for the percentiles
+WAIT_SAMPLES = 1000
+
+
+class PoolStats:
+    """Checkout counters for one pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.peak_checked_out = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, checked_out, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+            self.waits.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            waits = sorted(self.waits)
+            counts = {'checkouts': self.checkouts, 'timeouts': self.timeouts,
+                      'peak_checked_out': self.peak_checked_out}
+
+        def pct(p):
+            if not waits:
+                return None
+            return round(waits[min(len(waits) - 1, int(p / 100 * len(waits)))] * 1000, 3)
+
+        return {**counts,
+                'wait_p50_ms': pct(50), 'wait_p95_ms': pct(95), 'wait_p99_ms': pct(99),
+                'wait_max_ms': round(waits[-1] * 1000, 3) if waits else None}
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that times every checkout."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            conn = super().connect()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - started, self.checkedout(),
+                              timed_out=True)
+            raise
+
+        self.stats.record(time.perf_counter() - started, self.checkedout())
+        return conn
+
+    def capacity(self):
+        return self.size() + max(self._max_overflow, 0)
+
+    def metrics(self):
+        """Current use and checkout history of this pool."""
+
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'saturation': round(self.checkedout() / self.capacity(), 3),
+            **self.stats.summary(),
+        }
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings in `config`."""
+
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+    }
+
+    # in-memory SQLite is a single shared connection, not a pool
+    if not (url.get_backend_name() == 'sqlite'
+            and url.database in (None, '', ':memory:')):
+        options.update(
+            poolclass=MeteredQueuePool,
+            pool_size=config.get('DB_POOL_SIZE', 5),
+            max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+            pool_timeout=config.get('DB_POOL_TIMEOUT', 2),
+        )
+
+    timeout = config.get('DB_STATEMENT_TIMEOUT_MS')
+    if timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f"-c statement_timeout={int(timeout)}"}
+
+    return {**options, **config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+
+
+def lift_statement_timeout(conn):
+    """Let connection `conn` (e.g. `db.session.connection()`) run as long as
+    it needs, for the rest of its transaction."""
+
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql("SET LOCAL statement_timeout = 0")
+
+
+def pool_metrics(engines):
+    """{name: metrics} of the metered pools among `engines` ({name: engine})."""
+
+    return {name: engine.pool.metrics() for name, engine in engines.items()
+            if isinstance(engine.pool, MeteredQueuePool)}
+
+
+def init_app(app):
+    """Fill in SQLALCHEMY_ENGINE_OPTIONS; call before connecting the db."""
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
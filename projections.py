@@ -0,0 +1,119 @@
+"""Read-only rows for pages that only render what they load.
+
+The home and profile feeds, the user directory and the follow lists used to
+build full `User` / `Message` instances, each with its identity-map entry,
+attribute instrumentation and change tracking, only to render them once
+and throw them away. These pages now select just the columns their
+templates show and wrap each row in a small `__slots__` object:
+
+- `MessageRow`: what `message_card()` and the like button need, with the
+  author as an `AuthorRow` (shared by all of one author's messages on a page)
+- `UserRow`: what a user card shows
+
+The rows quack like the models as far as the templates are concerned
+(`msg.user.username`, `user.bio`, ...), but they aren't in the session.
+Nothing lazy-loads from them and nothing they hold can be saved. Code that
+changes data still loads the models.
+
+`python bench.py --only feed_orm_100 --only feed_rows_100` (and _1000)
+compares the two for a rendered profile page.
+"""
+
+from sqlalchemy import select
+
+from models import Message, User
+
+
+class Row:
+    """Base for the rows: equal, and with the same repr, when their values are.
+
+    (`httpcache.not_modified()` hashes the repr of its validators.)
+    """
+
+    __slots__ = ()
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.values() == self.values()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}{self.values()!r}"
+
+
+class AuthorRow(Row):
+    """The author of a `MessageRow`."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+class MessageRow(Row):
+    """A message, as a message card shows it."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    def __init__(self, id, text, timestamp, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user.id
+        self.user = user
+
+
+class UserRow(Row):
+    """A user, as a user card shows them."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+    def __init__(self, id, username, image_url, header_image_url, bio):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+
+
+def select_messages():
+    """SELECT of the `MessageRow` columns; add WHERE / ORDER BY to taste."""
+
+    return (select(Message.id, Message.text, Message.timestamp,
+                   Message.user_id, User.username, User.image_url)
+            .join(User, User.id == Message.user_id))
+
+
+def message_rows(rows):
+    """`MessageRow`s from the rows of `select_messages()`."""
+
+    authors = {}
+    messages = []
+
+    for id, text, timestamp, user_id, username, image_url in rows:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorRow(user_id, username, image_url)
+        messages.append(MessageRow(id, text, timestamp, author))
+
+    return messages
+
+
+def select_users():
+    """SELECT of the `UserRow` columns."""
+
+    return select(User.id, User.username, User.image_url,
+                  User.header_image_url, User.bio)
+
+
+def user_rows(rows):
+    """`UserRow`s from the rows of `select_users()`; columns added after
+    the card's (e.g. sort keys) are left out."""
+
+    width = len(UserRow.__slots__)
+    return [UserRow(*row[:width]) for row in rows]
@@ -0,0 +1,227 @@
+"""Per-request SQL statistics and N+1 detection.
+
+Counts every statement and the time spent in the database for each request,
+using SQLAlchemy engine events. The totals go out as response headers and a
+structured log line:
+
+    X-Query-Count: 4
+    X-Query-Time-Ms: 3.1
+    X-Query-Failed: 1       (only when a statement raised)
+
+When one request runs the same statement shape (same SQL, any parameters)
+over and over, that's almost always a lazy load in a loop, so those shapes are
+reported as suspected N+1s with the template line or call site that issued
+them.
+
+Settings:
+
+- QUERY_N_PLUS_ONE_THRESHOLD: repeats of one shape that count as an N+1 (3)
+- QUERY_BUDGET: max statements per request, or None for no limit
+- QUERY_BUDGETS: {endpoint: max statements} overrides for single routes
+- QUERY_BUDGET_RAISE: raise `QueryBudgetExceeded` instead of just logging,
+  so a test fails when a route goes over its budget
+"""
+
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 3
+
+# a bind parameter in any of the paramstyles we run on
+_PARAM = r"(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)"
+_IN_LIST = re.compile(r"\(\s*" + _PARAM + r"(?:\s*,\s*" + _PARAM + r")*\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL statements than its budget allows."""
+
+
+class QueryStats:
+    """SQL statements seen during one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.seconds = 0.0
+        # shape -> {'count', 'statement', 'parameters', 'site'}
+        self.shapes = {}
+
+    def record(self, statement, parameters, seconds, failed=False):
+        """Count one executed (or failed) statement."""
+
+        self.count += 1
+        self.failed += failed
+        self.seconds += seconds
+
+        shape = statement_shape(statement)
+        seen = self.shapes.get(shape)
+
+        if seen is None:
+            self.shapes[shape] = {'count': 1,
+                                  'statement': statement,
+                                  'parameters': parameters,
+                                  'site': None}
+            return
+
+        seen['count'] += 1
+        if seen['site'] is None:
+            seen['site'] = call_site()
+
+    def suspected_n_plus_one(self, threshold):
+        """Shapes that ran at least `threshold` times, most repeated first."""
+
+        repeated = [{'count': info['count'],
+                     'statement': shape[:200],
+                     'site': info['site']}
+                    for shape, info in self.shapes.items()
+                    if info['count'] >= threshold]
+
+        return sorted(repeated, key=lambda r: r['count'], reverse=True)
+
+
+def statement_shape(statement):
+    """Normalize SQL so the same query with different parameters matches.
+
+    Whitespace is collapsed and expanded `IN (?, ?, ...)` lists become `IN (?)`.
+    """
+
+    shape = _SPACE.sub(' ', statement).strip()
+    return _IN_LIST.sub('(?)', shape)
+
+
+def call_site():
+    """Describe where in our code the current statement came from.
+
+    Prefers the template line being rendered; otherwise the innermost frame
+    in this project that isn't library code.
+    """
+
+    frame = sys._getframe(1)
+    site = None
+
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            lineno = template.get_corresponding_lineno(frame.f_lineno)
+            return f"templates/{template.name}:{lineno}"
+
+        filename = frame.f_code.co_filename
+        if (site is None
+                and filename.startswith(ROOT)
+                and 'site-packages' not in filename
+                and filename != __file__):
+            rel = os.path.relpath(filename, ROOT)
+            site = f"{rel}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+        frame = frame.f_back
+
+    return site
+
+
+def current_stats():
+    """The `QueryStats` of the request in progress, or None."""
+
+    if not has_request_context():
+        return None
+    return g.get('query_stats')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, parameters, elapsed)
+
+
+def _handle_error(context):
+    # a statement that raised never reaches after_cursor_execute; pop its
+    # start here, or the list on the pooled connection grows forever
+    conn = context.connection
+    starts = conn.info.get('query_start') if conn is not None else None
+    if not starts or context.statement is None:
+        return
+
+    elapsed = time.perf_counter() - starts.pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.record(context.statement, context.parameters, elapsed, failed=True)
+
+
+def _start_request():
+    g.query_stats = QueryStats()
+
+
+def _finish_request(resp):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return resp
+
+    config = current_app.config
+    threshold = config.get('QUERY_N_PLUS_ONE_THRESHOLD',
+                           DEFAULT_N_PLUS_ONE_THRESHOLD)
+    suspects = stats.suspected_n_plus_one(threshold)
+
+    resp.headers['X-Query-Count'] = str(stats.count)
+    resp.headers['X-Query-Time-Ms'] = f"{stats.seconds * 1000:.1f}"
+    if stats.failed:
+        resp.headers['X-Query-Failed'] = str(stats.failed)
+    if suspects:
+        resp.headers['X-Query-N-Plus-One'] = str(len(suspects))
+
+    budget = config.get('QUERY_BUDGETS', {}).get(
+        request.endpoint, config.get('QUERY_BUDGET'))
+    over_budget = budget is not None and stats.count > budget
+
+    current_app.logger.log(
+        logging.WARNING if suspects or over_budget else logging.INFO,
+        json.dumps({'event': 'sql',
+                    'method': request.method,
+                    'path': request.path,
+                    'endpoint': request.endpoint,
+                    'status': resp.status_code,
+                    'queries': stats.count,
+                    'failed': stats.failed,
+                    'db_ms': round(stats.seconds * 1000, 1),
+                    'budget': budget,
+                    'n_plus_one': suspects}))
+
+    if over_budget and config.get('QUERY_BUDGET_RAISE'):
+        raise QueryBudgetExceeded(
+            f"{request.endpoint} ran {stats.count} queries (budget {budget})"
+            + "".join(f"\n  {s['count']}x at {s['site']}: {s['statement']}"
+                      for s in suspects))
+
+    return resp
+
+
+def init_app(app):
+    """Start counting SQL for every request to `app`.
+
+    Call before registering other `before_request` hooks so their queries
+    are counted too.
+    """
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,142 @@
+"""Send read-only pages' queries to read replicas.
+
+Views marked `@read_only` (profile, message, likes, user list, ...) run their
+SELECTs on one of the replicas in SQLALCHEMY_REPLICA_URIS, chosen per
+request. Everything else runs on the primary (SQLALCHEMY_DATABASE_URI), and
+so does any statement in a read-only view that isn't a plain SELECT, or that
+comes after something was written in the same transaction.
+
+Replicas lag a little, so someone who just posted, followed or liked could
+reload the page and not see it. To avoid that, committing a write during a
+request pins that browser session to the primary for REPLICA_PIN_SECONDS:
+read-your-writes, without pinning anyone else.
+
+Settings:
+
+- SQLALCHEMY_REPLICA_URIS: list of replica database URLs (default: none,
+  everything on the primary)
+- REPLICA_PIN_SECONDS: how long a session reads from the primary after it
+  writes (default 10)
+
+Replicas are plain engines (SQLALCHEMY_ENGINE_OPTIONS apply), so two local
+SQLite or PostgreSQL databases are enough to try this out.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+
+PIN_KEY = '_primary_until'
+
+
+class Replicas:
+    """Engines for an app's read replicas."""
+
+    def __init__(self, uris=(), pin_seconds=10, engine_options=None):
+        self.pin_seconds = pin_seconds
+        self.engines = [create_engine(uri, **(engine_options or {}))
+                        for uri in uris]
+
+    def choose(self):
+        return random.choice(self.engines)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+class RoutingSession(Session):
+    """Session that reads from a replica when the request allows it."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing
+                and not self.info.get('wrote')
+                and is_plain_select(clause)):
+            engine = g.get('replica') if has_request_context() else None
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def is_plain_select(clause):
+    return (clause is not None and clause.is_select
+            and getattr(clause, '_for_update_arg', None) is None)
+
+
+# remember writes, to stay on the primary for the rest of the transaction
+# and to pin the browser session once it commits
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _executed(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _committed(session):
+    if session.info.pop('wrote', False) and has_request_context():
+        pin_to_primary()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('wrote', None)
+
+
+def pin_to_primary():
+    """Read this browser session from the primary for a while."""
+
+    replicas = current_app.extensions['replicas']
+    if replicas.engines:
+        session[PIN_KEY] = time.time() + replicas.pin_seconds
+    g.replica = None
+
+
+def read_only(view):
+    """Let `view`'s queries go to a replica."""
+
+    view.read_only = True
+    return view
+
+
+def choose_replica():
+    """Pick this request's replica, if it may use one."""
+
+    g.replica = None
+    replicas = current_app.extensions['replicas']
+
+    if not replicas.engines or request.method not in ('GET', 'HEAD'):
+        return
+
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, 'read_only', False):
+        return
+
+    if session.get(PIN_KEY, 0) > time.time():
+        return
+
+    g.replica = replicas.choose()
+
+
+def init_app(app):
+    """Give `app` its replicas and route read-only requests to them.
+
+    Call before registering `before_request` hooks that query, so they can
+    use the replica too.
+    """
+
+    app.extensions['replicas'] = Replicas(
+        app.config.get('SQLALCHEMY_REPLICA_URIS', ()),
+        pin_seconds=app.config.get('REPLICA_PIN_SECONDS', 10),
+        engine_options=app.config.get('SQLALCHEMY_ENGINE_OPTIONS'))
+
+    app.before_request(choose_replica)
@@ -0,0 +1,324 @@
+"""Indexed search for Warbler.
+
+Users: a leading-wildcard `LIKE '%term%'` can't use a b-tree index, so every
+search read the whole users table. User search is instead backed by a
+substring index:
+
+- PostgreSQL: pg_trgm GIN indexes on username, bio and location, which serve
+  `ILIKE '%term%'` directly
+- SQLite: an FTS5 table with the trigram tokenizer, kept in sync with `users`
+  by triggers
+
+Messages: full-text search over `messages.text`:
+
+- PostgreSQL: a GIN index on `to_tsvector('english', text)`
+- SQLite: an FTS5 table (porter stemming), kept in sync by triggers
+
+Both indexes are maintained by the database as rows are inserted and deleted,
+so they update in the same transaction as `messages_add()` and
+`messages_destroy()`.
+
+The index objects aren't plain model indexes, so they're created by
+`install(conn)`, which runs after each table is created and from migrate.py.
+After a bulk load that bypassed them, `reindex(conn)` rebuilds them;
+load_data.py instead drops them with `uninstall(conn)` for the load and
+installs them again afterwards.
+"""
+
+import re
+from datetime import datetime, time
+
+from sqlalchemy import DDL, Float, case, cast, event, func, literal_column, or_, select, table
+
+from loading import message_cards, user_cards
+from models import db, Message, User
+from pagination import keyset, make_page
+
+# shortest term the trigram indexes can look up; shorter terms only match
+# username prefixes
+MIN_TRIGRAM = 3
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_bio_trgm "
+    "ON users USING gin (bio gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_location_trgm "
+    "ON users USING gin (location gin_trgm_ops)",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, bio, location, content='users', content_rowid='id', "
+    "tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts (rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+    "AFTER UPDATE OF username, bio, location ON users BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, username, bio, location) "
+    "VALUES ('delete', old.id, old.username, old.bio, old.location); "
+    "INSERT INTO users_fts (rowid, username, bio, location) "
+    "VALUES (new.id, new.username, new.bio, new.location); END",
+]
+
+MESSAGES_POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+    "ON messages USING gin (to_tsvector('english', text))",
+]
+
+MESSAGES_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, content='messages', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update "
+    "AFTER UPDATE OF text ON messages BEGIN "
+    "INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+]
+
+SEARCH_INDEXES = ('ix_users_username_trgm', 'ix_users_bio_trgm',
+                  'ix_users_location_trgm', 'ix_messages_text_fts')
+
+SEARCH_TRIGGERS = ('users_fts_insert', 'users_fts_delete', 'users_fts_update',
+                   'messages_fts_insert', 'messages_fts_delete',
+                   'messages_fts_update')
+
+# the to_tsvector() expression must match the index's exactly to use it,
+# so the config is inlined as a regconfig rather than bound as a parameter
+TS_CONFIG = literal_column("'english'::regconfig")
+
+users_fts = table('users_fts')
+messages_fts = table('messages_fts')
+
+
+def _run(conn, postgres, sqlite, fts_table):
+    if conn.dialect.name == 'postgresql':
+        for sql in postgres:
+            conn.exec_driver_sql(sql)
+
+    elif conn.dialect.name == 'sqlite':
+        for sql in sqlite:
+            conn.exec_driver_sql(sql)
+        conn.exec_driver_sql(
+            f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+
+def install_users(conn):
+    """Create the user search indexes if they're missing.
+
+    On SQLite this also (re)builds the FTS table from existing users.
+    """
+
+    _run(conn, POSTGRES_DDL, SQLITE_DDL, 'users_fts')
+
+
+def install_messages(conn):
+    """Create the message search indexes if they're missing.
+
+    On SQLite this also (re)builds the FTS table from existing messages.
+    """
+
+    _run(conn, MESSAGES_POSTGRES_DDL, MESSAGES_SQLITE_DDL, 'messages_fts')
+
+
+def install(conn):
+    """Create every search index for `conn`'s database if it's missing."""
+
+    install_users(conn)
+    install_messages(conn)
+
+
+def uninstall(conn):
+    """Drop the search indexes (SQLite: the sync triggers) so a bulk load
+    doesn't maintain them row by row. `install()` puts them back and
+    rebuilds them."""
+
+    if conn.dialect.name == 'postgresql':
+        for index in SEARCH_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+
+    elif conn.dialect.name == 'sqlite':
+        for trigger in SEARCH_TRIGGERS:
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+
+
+def reindex(conn):
+    """Rebuild every search index from scratch, e.g. after a bulk load."""
+
+    if conn.dialect.name == 'postgresql':
+        for index in SEARCH_INDEXES:
+            conn.exec_driver_sql(f"REINDEX INDEX {index}")
+
+    elif conn.dialect.name == 'sqlite':
+        for fts_table in ('users_fts', 'messages_fts'):
+            conn.exec_driver_sql(
+                f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+
+event.listen(User.__table__, 'after_create',
+             lambda target, conn, **kw: install_users(conn))
+event.listen(Message.__table__, 'after_create',
+             lambda target, conn, **kw: install_messages(conn))
+
+# triggers go with their table; the FTS tables have to be dropped by hand
+event.listen(User.__table__, 'after_drop',
+             DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect='sqlite'))
+event.listen(Message.__table__, 'after_drop',
+             DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+
+
+def _like_escape(term):
+    """Escape LIKE wildcards (with `/`, as SQLAlchemy's autoescape does)."""
+
+    return (term.replace('/', '//')
+                .replace('%', '/%')
+                .replace('_', '/_'))
+
+
+def _fts_phrase(term):
+    """Quote `term` as a single FTS5 phrase (a substring, with trigrams)."""
+
+    return '"' + term.replace('"', '""') + '"'
+
+
+def user_rank(term):
+    """SQL rank of a user for `term`; lower is better.
+
+    0 exact username, 1 username prefix, 2 username substring,
+    3 bio/location only.
+    """
+
+    escaped = _like_escape(term)
+
+    return case(
+        (func.lower(User.username) == term.lower(), 0),
+        (User.username.ilike(f"{escaped}%", escape='/'), 1),
+        (User.username.ilike(f"%{escaped}%", escape='/'), 2),
+        else_=3,
+    )
+
+
+def user_matches(term):
+    """SQL condition for users whose username, bio or location has `term`."""
+
+    dialect = db.session.get_bind().dialect.name
+
+    if len(term) < MIN_TRIGRAM:
+        # too short for trigrams, so only look for a username prefix
+        return User.username.ilike(f"{_like_escape(term)}%", escape='/')
+
+    if dialect == 'sqlite':
+        matched = (select(literal_column('rowid'))
+                   .select_from(users_fts)
+                   .where(literal_column('users_fts').op('MATCH')(_fts_phrase(term))))
+        return User.id.in_(matched)
+
+    pattern = f"%{_like_escape(term)}%"
+    return or_(User.username.ilike(pattern, escape='/'),
+               User.bio.ilike(pattern, escape='/'),
+               User.location.ilike(pattern, escape='/'))
+
+
+def ts_rank(vector, tsquery):
+    """PostgreSQL's ts_rank() as double precision.
+
+    ts_rank() returns real. Compared against a cursor (a Python float, so
+    float8), each page's last row would come out slightly below its own
+    cursor and be repeated on the next page.
+    """
+
+    return cast(func.ts_rank(vector, tsquery), Float)
+
+
+def search_users(term, before=None, after=None, limit=20):
+    """One page of users matching `term`, best matches first, as a `Page`.
+
+    Pages are keyed on (rank, id), so `before` / `after` are cursors from a
+    previous page of the same search.
+    """
+
+    term = term.strip()
+    rank = user_rank(term).label('rank')
+
+    rows = db.session.execute(keyset(
+        select(User, rank).where(user_matches(term)).options(*user_cards()),
+        (rank, User.id),
+        before, after, limit,
+        descending=False)).all()
+
+    page = make_page(rows, lambda row: (row.rank, row.User.id),
+                     before, after, limit)
+    page.items = [row.User for row in page.items]
+
+    return page
+
+
+def _fts_query(term):
+    """Turn free text into a safe FTS5 query: every word, as a phrase."""
+
+    words = re.findall(r"\w+", term)
+    return ' '.join(_fts_phrase(word) for word in words)
+
+
+def search_messages(term, since=None, until=None, order='recent',
+                    before=None, after=None, limit=20):
+    """One page of messages matching `term`, as a `Page`.
+
+    `order` is 'recent' (newest first, keyed on (timestamp, id)) or 'rank'
+    (best match first, keyed on (rank, id)). `since` / `until` are dates
+    bounding the message timestamp, inclusive.
+    """
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        query = _fts_query(term)
+        if not query:
+            return make_page([], None)
+
+        fts = (select(literal_column('rowid').label('id'),
+                      (-func.bm25(literal_column('messages_fts'))).label('rank'))
+               .select_from(messages_fts)
+               .where(literal_column('messages_fts').op('MATCH')(query))
+               .subquery())
+        rank = fts.c.rank
+        stmt = select(Message, rank).join(fts, fts.c.id == Message.id)
+
+    else:
+        vector = func.to_tsvector(TS_CONFIG, Message.text)
+        tsquery = func.websearch_to_tsquery(TS_CONFIG, term)
+        rank = ts_rank(vector, tsquery).label('rank')
+        stmt = select(Message, rank).where(vector.op('@@')(tsquery))
+
+    stmt = stmt.options(*message_cards())
+
+    if since is not None:
+        stmt = stmt.where(Message.timestamp >= datetime.combine(since, time.min))
+    if until is not None:
+        stmt = stmt.where(Message.timestamp <= datetime.combine(until, time.max))
+
+    if order == 'rank':
+        columns = (rank, Message.id)
+        sort_key = lambda row: (row.rank, row.Message.id)
+    else:
+        columns = (Message.timestamp, Message.id)
+        sort_key = lambda row: (row.Message.timestamp, row.Message.id)
+
+    rows = db.session.execute(
+        keyset(stmt, columns, before, after, limit)).all()
+
+    page = make_page(rows, sort_key, before, after, limit)
+    page.items = [row.Message for row in page.items]
+
+    return page
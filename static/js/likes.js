@@ -0,0 +1,33 @@
+// Like / unlike messages without reloading the page.
+//
+// Each like button sits in a `.like-form` that still works as a plain form
+// POST; with JavaScript we call the JSON API instead and just flip the button.
+
+document.addEventListener('submit', async function (evt) {
+  const form = evt.target.closest('.like-form');
+  if (!form) return;
+
+  evt.preventDefault();
+
+  const button = form.querySelector('button');
+  const liked = button.classList.contains('btn-primary');
+
+  button.disabled = true;
+  try {
+    const resp = await fetch(form.dataset.url, {
+      method: liked ? 'DELETE' : 'PUT',
+      credentials: 'same-origin',
+      headers: { 'Accept': 'application/json' },
+    });
+
+    // fall back to the form if the API isn't happy (e.g. logged out)
+    if (!resp.ok) return form.submit();
+
+    const data = await resp.json();
+    button.classList.toggle('btn-primary', data.liked);
+    button.classList.toggle('btn-secondary', !data.liked);
+    button.title = `${data.likes} like${data.likes === 1 ? '' : 's'}`;
+  } finally {
+    button.disabled = false;
+  }
+});
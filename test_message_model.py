@@ -7,6 +7,7 @@ from sqlalchemy import exc
 from models import db, User, Message, Follows
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 from app import app
 
@@ -6,9 +6,14 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
+from sqlalchemy import literal_column
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import InvalidRequestError
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,11 +21,16 @@ from models import db, connect_db, Message, User
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from loading import user_cards
+from projections import MessageRow, UserRow, user_rows, select_users
+import search
+import timeline
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -39,8 +49,13 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        app.extensions['user_cache'].clear()
+        app.extensions['fragment_cache'].clear()
+        TimelineEntry.query.delete()
+        Follows.query.delete()
         User.query.delete()
         Message.query.delete()
+        Likes.query.delete()
 
         self.client = app.test_client()
 
@@ -55,6 +70,8 @@ class MessageViewTestCase(TestCase):
         """Clear any failed transactions"""
         
         db.session.rollback()
+        #forget this test's objects; the next test's rows can reuse their ids
+        db.session.expunge_all()
         
     #################################################################
     # MESSAGE CREATION TESTS    
@@ -183,5 +200,436 @@ class MessageViewTestCase(TestCase):
             
             msg = Message.query.get(300)
             self.assertIsNotNone(msg)
-            
-            
\ No newline at end of file
+
+    #################################################################
+    # TIMELINE TESTS
+    #################################################################
+
+    def follower_setup(self):
+        """Make a second user who follows testuser"""
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                               user_following_id=follower.id))
+        User.adjust_counts(self.testuser.id, followers_count=1)
+        User.adjust_counts(follower.id, following_count=1)
+        db.session.commit()
+
+        return follower
+
+    def test_add_message_fans_out(self):
+        """Is a new message delivered to the author's and followers' timelines?"""
+        follower = self.follower_setup()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Fan me out"})
+
+        msg = Message.query.one()
+        owners = {e.owner_id for e in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(owners, {self.testuser.id, follower.id})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower.id
+
+            resp = c.get("/")
+            self.assertIn("Fan me out", str(resp.data))
+
+    def test_popular_author_fans_out_on_read(self):
+        """Are popular authors' messages merged in when the feed is read?"""
+        follower = self.follower_setup()
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post("/messages/new", data={"text": "Read me later"})
+
+                #only the author's own inbox is written
+                self.assertEqual(TimelineEntry.query.count(), 1)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower.id
+
+                resp = c.get("/")
+                self.assertIn("Read me later", str(resp.data))
+        finally:
+            app.config.pop('TIMELINE_FANOUT_LIMIT')
+
+    def test_followed_over_limit(self):
+        """Does gaining a follower over the limit switch an author to
+        fan-out-on-read, so the new follower still sees their messages?"""
+        follower = self.follower_setup()
+        author_id, follower_id = self.testuser.id, follower.id
+        app.config['TIMELINE_FANOUT_LIMIT'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+                c.post("/messages/new", data={"text": "Posted early"})
+
+                other = User.signup(username="other", email="other@test.com",
+                                    password="other", image_url=None)
+                db.session.commit()
+                other_id = other.id
+
+                #the second follower isn't backfilled
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = other_id
+                c.post(f"/users/follow/{author_id}")
+                self.assertEqual(TimelineEntry.query.filter_by(owner_id=other_id).count(), 0)
+
+                db.session.expire_all()
+                self.assertTrue(db.session.get(User, author_id).fanout_on_read)
+                self.assertEqual(timeline.celebrity_ids(other_id), [author_id])
+                self.assertEqual(timeline.celebrity_ids(follower_id), [author_id])
+
+                resp = c.get("/")
+                self.assertIn("Posted early", resp.text)
+        finally:
+            app.config.pop('TIMELINE_FANOUT_LIMIT')
+
+    def test_popular_author_drops_under_limit(self):
+        """Do a popular author's messages stay in feeds after they lose
+        followers?"""
+        follower = self.follower_setup()
+        author_id, follower_id = self.testuser.id, follower.id
+        app.config['TIMELINE_FANOUT_LIMIT'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+
+                other = User.signup(username="other", email="other@test.com",
+                                    password="other", image_url=None)
+                db.session.commit()
+                other_id = other.id
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = other_id
+                c.post(f"/users/follow/{author_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+                c.post("/messages/new", data={"text": "Still here"})
+
+                #back under the limit
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = other_id
+                c.post(f"/users/stop-following/{author_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+                resp = c.get("/")
+                self.assertIn("Still here", resp.text)
+
+                #and new messages are still read at request time
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+                c.post("/messages/new", data={"text": "Also here"})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+                resp = c.get("/")
+                self.assertIn("Also here", resp.text)
+        finally:
+            app.config.pop('TIMELINE_FANOUT_LIMIT')
+
+    def test_delete_message_prunes_timelines(self):
+        """Is a deleted message removed from every timeline?"""
+        self.follower_setup()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Short lived"})
+            msg = Message.query.one()
+            c.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    #################################################################
+    # COUNTER TESTS
+    #################################################################
+
+    def test_message_counter(self):
+        """Does the messages counter follow adds and deletes?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "one"})
+            c.post("/messages/new", data={"text": "two"})
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 2)
+
+            msg = Message.query.filter_by(text="one").one()
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 1)
+
+    #################################################################
+    # SEARCH TESTS
+    #################################################################
+
+    def test_search_messages(self):
+        """Does full-text search find messages as they're added and deleted?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Warblers are singing today"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            resp = c.get("/messages/search?q=warbler+singing")
+            self.assertIn("Warblers are singing today", resp.text)
+            self.assertNotIn("Nothing to see here", resp.text)
+
+            resp = c.get("/messages/search?q=singing&sort=rank")
+            self.assertIn("Warblers are singing today", resp.text)
+
+            msg = Message.query.filter_by(text="Warblers are singing today").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            resp = c.get("/messages/search?q=singing")
+            self.assertIn("no warbles found", resp.text)
+
+    def test_search_messages_rank_pages(self):
+        """Do pages of ranked results follow on without repeats?"""
+        db.session.add_all([Message(text=f"warble {'warble ' * n}", user_id=self.testuser.id)
+                            for n in range(3)])
+        db.session.commit()
+
+        seen = []
+        with self.client as c:
+            url = "/messages/search?q=warble&sort=rank&limit=1"
+            while url:
+                resp = c.get(url)
+                seen += re.findall(r'<p>(warble[ a-z]*?)\s*</p>', resp.text)
+                match = re.search(r'href="([^"]*before=[^"]*)"', resp.text)
+                url = match and match.group(1).replace('&amp;', '&')
+                self.assertLess(len(seen), 10)
+
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(len(set(seen)), 3)
+
+        #on PostgreSQL the real from ts_rank() is compared as a float8
+        rank = search.ts_rank(literal_column('v'), literal_column('q'))
+        self.assertIn('AS FLOAT', str(rank.compile(dialect=postgresql.dialect())))
+
+    def test_search_messages_dates(self):
+        """Are search results limited to the requested dates?"""
+        old = Message(text='an old warble', user_id=self.testuser.id,
+                      timestamp=datetime(2020, 1, 1))
+        new = Message(text='a new warble', user_id=self.testuser.id,
+                      timestamp=datetime(2024, 6, 1))
+        db.session.add_all([old, new])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/messages/search?q=warble&since=2024-01-01")
+            self.assertIn("a new warble", resp.text)
+            self.assertNotIn("an old warble", resp.text)
+
+            resp = c.get("/messages/search?q=warble&until=2020-01-01")
+            self.assertIn("an old warble", resp.text)
+            self.assertNotIn("a new warble", resp.text)
+
+            resp = c.get("/messages/search?q=warble&since=yesterday")
+            self.assertEqual(resp.status_code, 400)
+
+    #################################################################
+    # LIKE API TESTS
+    #################################################################
+
+    def test_like_api(self):
+        """Are like / unlike idempotent and do they report the new count?"""
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text='likeable', user_id=other.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, other_id = msg.id, other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for _ in range(2):
+                resp = c.put(f"/api/messages/{msg_id}/like")
+                self.assertEqual(resp.json, {"message_id": msg_id, "liked": True, "likes": 1})
+            self.assertEqual(User.query.get(self.testuser.id).likes_count, 1)
+
+            #a second user can like the same message
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            resp = c.put(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.json["likes"], 2)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            for _ in range(2):
+                resp = c.delete(f"/api/messages/{msg_id}/like")
+                self.assertEqual(resp.json, {"message_id": msg_id, "liked": False, "likes": 1})
+            self.assertEqual(User.query.get(self.testuser.id).likes_count, 0)
+
+            resp = c.put("/api/messages/999999/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_delete_liked_message(self):
+        """Are a deleted message's likes removed, and their likers' counters
+        with them, when the message or its author is deleted?"""
+        liker = User.signup("liker", "liker@test.com", "password", None)
+        db.session.commit()
+        msgs = [Message(text=f'liked {n}', user_id=self.testuser.id) for n in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids, liker_id, author_id = [m.id for m in msgs], liker.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+            for msg_id in msg_ids:
+                c.put(f"/api/messages/{msg_id}/like")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+            c.post(f"/messages/{msg_ids[0]}/delete")
+
+            db.session.expire_all()
+            self.assertEqual(User.query.get(liker_id).likes_count, 2)
+            self.assertEqual(Likes.query.filter_by(message_id=msg_ids[0]).count(), 0)
+
+            c.post("/users/delete")
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(liker_id).likes_count, 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_like_api_nouser(self):
+        """Is the like API refused when logged out?"""
+        with self.client as c:
+            resp = c.put("/api/messages/1/like")
+            self.assertEqual(resp.status_code, 401)
+
+    #################################################################
+    # LIST PAGE QUERY TESTS
+    #################################################################
+
+    def test_list_queries_fixed(self):
+        """Does a list page run the same queries for one author or many?"""
+        authors = [User(username=f"author{n}", email=f"author{n}@test.com",
+                        password="password") for n in range(4)]
+        db.session.add_all(authors)
+        db.session.commit()
+        msgs = [Message(text=f"by author{n}", user_id=a.id) for n, a in enumerate(authors)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        user_id = self.testuser.id
+        liked = [(m.id, m.text) for m in msgs]
+
+        def likes_page_queries(liked):
+            Likes.query.delete()
+            db.session.add_all([Likes(user_id=user_id, message_id=msg_id)
+                                for msg_id, _ in liked])
+            db.session.commit()
+            app.extensions['fragment_cache'].clear()
+            db.session.expunge_all()
+
+            resp = self.client.get(f"/users/{user_id}/likes")
+            self.assertEqual(resp.status_code, 200)
+            for _, text in liked:
+                self.assertIn(text, resp.text)
+            return int(resp.headers['X-Query-Count'])
+
+        one = likes_page_queries(liked[:1])
+        many = likes_page_queries(liked)
+        self.assertEqual(one, many)
+
+    def test_lazy_load_raises(self):
+        """Do list-page objects refuse to lazy load in development and tests?"""
+        db.session.expunge_all()
+        user = User.query.options(*user_cards()).first()
+
+        with self.assertRaises(InvalidRequestError):
+            user.messages
+
+    #################################################################
+    # PROJECTION ROW TESTS
+    #################################################################
+
+    def test_feed_rows(self):
+        """Do the feeds load plain rows, one author row per author?"""
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post("/messages/new", data={"text": "first"})
+            c.post("/messages/new", data={"text": "second"})
+
+        feed = list(timeline.home_feed(user_id))
+        self.assertEqual(len(feed), 2)
+        self.assertTrue(all(isinstance(m, MessageRow) for m in feed))
+        self.assertIs(feed[0].user, feed[1].user)
+        self.assertEqual(feed[0].user.username, "testuser")
+
+        resp = self.client.get(f"/users/{user_id}")
+        self.assertIn("first", resp.text)
+        self.assertIn("second", resp.text)
+
+    def test_user_rows(self):
+        """Do user rows compare (and repr, for ETags) by every column?"""
+        user_id = self.testuser.id
+        before, = user_rows(db.session.execute(select_users()))
+        self.assertIsInstance(before, UserRow)
+
+        User.query.get(user_id).bio = "new bio"
+        db.session.commit()
+        after, = user_rows(db.session.execute(select_users()))
+
+        self.assertNotEqual(before, after)
+        self.assertNotEqual(repr(before), repr(after))
+        self.assertEqual(after, user_rows(db.session.execute(select_users()))[0])
+
+    #################################################################
+    # FRAGMENT CACHE TESTS
+    #################################################################
+
+    def test_message_card_cache(self):
+        """Are message cards cached, and refreshed when the author changes?"""
+        cache = app.extensions['fragment_cache']
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "cache me"})
+            msg_id = Message.query.filter_by(text="cache me").one().id
+
+            resp = c.get(f"/users/{self.testuser.id}")
+            self.assertIn("cache me", resp.text)
+            self.assertIsNotNone(cache.get(msg_id))
+
+            #renamed author: the cached card is re-rendered
+            user = User.query.get(self.testuser.id)
+            user.username = "renamed"
+            db.session.commit()
+            resp = c.get(f"/users/{self.testuser.id}")
+            self.assertIn("@renamed", resp.text)
+            self.assertNotIn("@testuser", resp.text)
+
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertIsNone(cache.get(msg_id))
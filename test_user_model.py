@@ -6,10 +6,11 @@
 
 
 import os
+import tempfile
 from unittest import TestCase
-from sqlalchemy import exc
+from sqlalchemy import create_engine, exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,11 +18,15 @@ from models import db, User, Message, Follows
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['WARBLER_CONFIG'] = 'test'
 
 
 # Now we can import app
 
 from app import app
+from passwords import PasswordHasher, PasswordPoolBusy, get_hasher
+import load_data
+import migrate
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -133,6 +138,30 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(self.user2.followers), 0)
         self.assertEqual(len(self.user2.following), 1)
     
+    def test_follow_and_like_ids(self):
+        """Is follow / like state for a page of ids fetched in one go?"""
+        msg = Message(text='liked', user_id=self.user2.id)
+        db.session.add_all([
+            msg,
+            Follows(user_being_followed_id=self.user2.id, user_following_id=self.user.id),
+        ])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user.id, message_id=msg.id))
+        db.session.commit()
+
+        self.assertTrue(self.user.has_liked(msg))
+        self.assertFalse(self.user2.has_liked(msg))
+
+        following, liked = self.user.follow_and_like_ids()
+        self.assertEqual(following, {self.user2.id})
+        self.assertEqual(liked, {msg.id})
+
+        #only the ids asked about come back
+        following, liked = self.user.follow_and_like_ids(
+            user_ids=[self.user.id], message_ids=[msg.id])
+        self.assertEqual(following, set())
+        self.assertEqual(liked, {msg.id})
+
     #################################################################
     # SIGNUP TESTS
     #################################################################
@@ -196,4 +225,120 @@ class UserModelTestCase(TestCase):
         self.assertFalse(bad_usr)
         #invalid password
         self.assertFalse(bad_pass)
-        
\ No newline at end of file
+
+    def test_rehash_on_login(self):
+        """Is a hash at an outdated cost upgraded on successful login?"""
+        hasher = get_hasher()
+        old_rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            usr = User.authenticate('usertest', 'HASHED')
+            db.session.commit()
+
+            self.assertTrue(usr.password.startswith('$2b$04$'))
+            self.assertFalse(hasher.needs_rehash(usr.password))
+            #still logs in with the new hash
+            self.assertTrue(User.authenticate('usertest', 'HASHED'))
+        finally:
+            hasher.rounds = old_rounds
+
+    def test_password_pool_busy(self):
+        """Does a full hashing pool refuse work instead of queueing it?"""
+        hasher = PasswordHasher(rounds=4, workers=1, queue_depth=0)
+        try:
+            self.assertTrue(hasher.hash('pw').startswith('$2b$04$'))
+
+            #take the only slot, as a running job would
+            hasher._slots.acquire()
+            with self.assertRaises(PasswordPoolBusy):
+                hasher.hash('pw')
+        finally:
+            hasher.shutdown()
+
+    #################################################################
+    # COUNTER TESTS
+    #################################################################
+
+    def test_reconcile_counts(self):
+        """Are drifted counters recomputed from the source tables?"""
+        db.session.add(Follows(user_being_followed_id=self.user2.id, user_following_id=self.user.id))
+        db.session.add(Message(text='counted', user_id=self.user.id))
+        self.user2.likes_count = 7
+        db.session.commit()
+
+        fixed = User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(fixed, 2)
+        self.assertEqual(self.user.messages_count, 1)
+        self.assertEqual(self.user.following_count, 1)
+        self.assertEqual(self.user2.followers_count, 1)
+        self.assertEqual(self.user2.likes_count, 0)
+
+        #nothing left to fix
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    #################################################################
+    # MIGRATION TESTS
+    #################################################################
+
+    def test_migrate_up_to_date(self):
+        """Does a freshly created schema need no migration?"""
+        self.assertEqual(migrate.missing_tables(db.engine), [])
+        self.assertEqual(migrate.pending_statements(db.engine), [])
+
+    def test_migrate_sqlite_likes(self):
+        """Is SQLite's old UNIQUE(likes.message_id) dropped by a table rebuild?"""
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/old.db")
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.exec_driver_sql("DROP TABLE likes")
+                conn.exec_driver_sql(
+                    "CREATE TABLE likes (id INTEGER NOT NULL, user_id INTEGER, "
+                    "message_id INTEGER, PRIMARY KEY (id), UNIQUE (message_id))")
+                conn.exec_driver_sql("INSERT INTO likes VALUES (7, 1, 1)")
+
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                for sql in migrate.pending_statements(engine):
+                    conn.exec_driver_sql(sql)
+
+            self.assertEqual(migrate.pending_statements(engine), [])
+            with engine.begin() as conn:
+                conn.exec_driver_sql("INSERT INTO likes (user_id, message_id) VALUES (2, 1)")
+                rows = conn.exec_driver_sql("SELECT id, user_id FROM likes ORDER BY id").all()
+            self.assertEqual([tuple(r) for r in rows], [(7, 1), (8, 2)])
+            engine.dispose()
+
+    #################################################################
+    # BULK LOAD TESTS
+    #################################################################
+
+    def test_load_data(self):
+        """Are CSV dumps loaded in chunks, resumably, with counters rebuilt?"""
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'users.csv'), 'w') as f:
+                f.write("email,username,image_url,password,bio,header_image_url,location\n")
+                for i in range(5):
+                    f.write(f"u{i}@test.com,user{i},/img.png,HASHED,,/hdr.png,Here\n")
+            with open(os.path.join(tmp, 'messages.csv'), 'w') as f:
+                f.write("text,timestamp,user_id\n")
+                f.write("hello,2020-01-01 10:00:00.000000,1\n")
+                f.write("again,2020-01-02 10:00:00.000000,1\n")
+            with open(os.path.join(tmp, 'follows.csv'), 'w') as f:
+                f.write("user_being_followed_id,user_following_id\n2,1\n1,2\n1,3\n")
+
+            db.session.close()
+            load_data.load(tmp, chunk_size=2, reset=True)
+            #a second run finds everything loaded and adds nothing
+            load_data.load(tmp, chunk_size=2)
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 2)
+
+        user = User.query.get(1)
+        self.assertEqual(user.username, 'user0')
+        self.assertEqual(user.bio, '')
+        self.assertEqual(user.messages_count, 2)
+        self.assertEqual(user.followers_count, 2)
+        self.assertEqual(migrate.pending_statements(db.engine), [])
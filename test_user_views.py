@@ -1,19 +1,70 @@
 """Tests for user views"""
+import base64
+import gzip
 import os
+import re
+import tempfile
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, TimelineEntry
 
 os.environ['DATABASE_URL'] =  'postgresql:///warbler-test'
-from app import app, CURR_USER_KEY
+os.environ['WARBLER_CONFIG'] = 'test'
+from app import app, create_app, CURR_USER_KEY
+from querystats import QueryStats, QueryBudgetExceeded
+from caching import LRUCache
+from pagination import encode_cursor
+import assets
+import build_assets
+import images
+import load_data
+import pooling
+import replicas
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
+
+# a 1x1 PNG, for the stub image server
+PIXEL = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==')
+
+# an SVG that runs script, if served from our origin
+EVIL_SVG = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+
+class StubImageHandler(BaseHTTPRequestHandler):
+    """Serves PIXEL at /avatar.png, EVIL_SVG at /evil.svg (and as a PNG at
+    /evil.png), a redirect to ftp at /to-ftp and a web page anywhere else."""
+    hits = []
+    bodies = {'/avatar.png': ('image/png', PIXEL),
+              '/evil.svg': ('image/svg+xml', EVIL_SVG),
+              '/evil.png': ('image/png', EVIL_SVG)}
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path == '/to-ftp':
+            self.send_response(302)
+            self.send_header('Location', 'ftp://127.0.0.1/avatar.png')
+            self.end_headers()
+            return
+        content_type, body = self.bodies.get(self.path, ('text/html', b'<html></html>'))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
 class UserViewTestCase(TestCase):
     """Test views for users."""
     
     def setUp(self):
         """Create test client, add sample data"""
         
+        app.extensions['user_cache'].clear()
+        TimelineEntry.query.delete()
         User.query.delete()
         Message.query.delete()
         Likes.query.delete()
@@ -116,6 +167,94 @@ class UserViewTestCase(TestCase):
             self.assertIn("testuser", res_str)
             self.assertNotIn("user2", res_str)
     
+    def test_follow_buttons_from_page(self):
+        """Do follow buttons come from the users on the page, not the cached sets?"""
+        self.followSetUp()
+        cache = app.extensions['user_cache']
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/users')
+            #a stale entry that thinks testuser follows user2, not user3
+            cache.get(self.testuser.id).following_ids = frozenset([2])
+            db.session.expunge_all()
+
+            resp = c.get('/users')
+            self.assertIn('action="/users/stop-following/3"', resp.text)
+            self.assertNotIn('action="/users/stop-following/2"', resp.text)
+
+            resp = c.get('/users/2')
+            self.assertIn('action="/users/follow/2"', resp.text)
+
+    def test_following_paginates(self):
+        """Are follows listed newest first, a page at a time?"""
+        db.session.add_all([
+            Follows(user_being_followed_id=2, user_following_id=1,
+                    created_at=datetime(2024, 1, 1)),
+            Follows(user_being_followed_id=3, user_following_id=1,
+                    created_at=datetime(2024, 2, 1)),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get('/users/1/following?limit=1')
+            self.assertIn('@user3', resp.text)
+            self.assertNotIn('@user2', resp.text)
+
+            match = re.search(r'href="([^"]*before=[^"]*)"', resp.text)
+            resp = c.get(match.group(1).replace('&amp;', '&'))
+            self.assertIn('@user2', resp.text)
+            self.assertNotIn('@user3', resp.text)
+
+    def test_loaded_follows_paginate(self):
+        """Do follows bulk loaded by load_data page all the way through?"""
+        db.session.add_all([User(id=n, username=f'user{n}', email=f'user{n}@email.com',
+                                 password='password') for n in (4, 5)])
+        db.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'follows.csv')
+            with open(path, 'w') as f:
+                f.write('user_being_followed_id,user_following_id\n')
+                f.writelines(f'1,{n}\n' for n in (2, 3, 4, 5))
+            load_data.load_file(path, 'follows', False, 10)
+
+        seen = []
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            url = '/users/1/followers?limit=2'
+            while url:
+                resp = c.get(url)
+                seen += re.findall(r'<p>@(user\d)</p>', resp.text)
+                match = re.search(r'href="([^"]*before=[^"]*)"', resp.text)
+                url = match and match.group(1).replace('&amp;', '&')
+                self.assertLess(len(seen), 10)
+
+        self.assertEqual(sorted(seen), ['user2', 'user3', 'user4', 'user5'])
+
+    def test_directory_paginates(self):
+        """Is the user directory most followed first, a page at a time?"""
+        User.query.get(3).followers_count = 5
+        User.query.get(2).followers_count = 2
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/users?limit=2')
+            self.assertLess(resp.text.index('@user3'), resp.text.index('@user2'))
+            self.assertNotIn('@testuser', resp.text)
+
+            match = re.search(r'href="([^"]*before=[^"]*)"', resp.text)
+            resp = c.get(match.group(1).replace('&amp;', '&'))
+            self.assertIn('@testuser', resp.text)
+            self.assertNotIn('@user2', resp.text)
+
     def test_nouser_show_following(self):
         """If not logged in, is access to following page denied?"""
         with self.client as c:
@@ -150,7 +289,40 @@ class UserViewTestCase(TestCase):
             self.assertIn("user2", res_str)
             self.assertIn('<h4 id="sidebar-username">@testuser</h4>', res_str) #show this is testuser's profile
             self.assertEqual(len(self.testuser.following), 1)
+            self.assertEqual(self.testuser.following_count, 1)
+            self.assertEqual(self.user2.followers_count, 1)
             
+    def test_add_follow_twice_or_self(self):
+        """Are repeat follows and self-follows ignored?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY]=self.testuser.id
+            c.post(f"/users/follow/{self.user2.id}")
+            resp = c.post(f"/users/follow/{self.user2.id}")
+            self.assertEqual(resp.status_code, 302)
+            resp = c.post(f"/users/follow/{self.testuser.id}")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(Follows.query.count(), 1)
+            self.assertEqual(self.testuser.following_count, 1)
+
+    def test_stop_following_not_followed(self):
+        """Is unfollowing someone you don't follow (or yourself) ignored?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY]=self.testuser.id
+            c.post(f"/users/follow/{self.user2.id}")
+
+            for user_id in (self.user3.id, self.testuser.id):
+                resp = c.post(f"/users/stop-following/{user_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(Follows.query.count(), 1)
+            db.session.expire_all()
+            self.assertEqual(User.query.get(1).following_count, 1)
+            self.assertEqual(User.query.get(3).followers_count, 0)
+            self.assertEqual(User.query.get(1).followers_count, 0)
+
     def test_add_follow_nouser(self):
         """Does adding a follow fail if no user logged in?"""
         
@@ -192,4 +364,545 @@ class UserViewTestCase(TestCase):
             res_str = str(resp.data)
             
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized", res_str)
\ No newline at end of file
+            self.assertIn("Access unauthorized", res_str)
+
+    #################################################################
+    # TIMELINE TESTS
+    #################################################################
+    def test_follow_backfills_timeline(self):
+        """Are a user's messages copied to the timeline on follow and removed on unfollow?"""
+        msg = Message(text='before the follow', user_id=self.user2.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{self.user2.id}")
+            entries = TimelineEntry.query.filter_by(owner_id=self.testuser.id).all()
+            self.assertEqual([e.message_id for e in entries], [msg_id])
+
+            resp = c.get("/")
+            self.assertIn("before the follow", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.user2.id}")
+            self.assertEqual(TimelineEntry.query.filter_by(owner_id=self.testuser.id).count(), 0)
+
+    #################################################################
+    # PAGINATION TESTS
+    #################################################################
+    def test_profile_pagination(self):
+        """Does the profile feed page through messages that share a timestamp?"""
+        msgs = [Message(text=f'warble #{i}', user_id=self.user2.id) for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user2.id}?limit=2")
+            res_str = str(resp.data)
+            self.assertIn('warble #4', res_str)
+            self.assertIn('warble #3', res_str)
+            self.assertNotIn('warble #2', res_str)
+
+            seen = []
+            url = f"/users/{self.user2.id}?limit=2"
+            while url:
+                resp = c.get(url)
+                seen += [int(m) for m in re.findall(r'warble #(\d)<', resp.text)]
+                match = re.search(r'href="([^"]*before=[^"]*)"', resp.text)
+                url = match.group(1).replace('&amp;', '&') if match else None
+
+            self.assertEqual(seen, [4, 3, 2, 1, 0])
+
+            #newer link from the last page goes back towards the top
+            match = re.search(r'href="([^"]*after=[^"]*)"', resp.text)
+            resp = c.get(match.group(1).replace('&amp;', '&'))
+            self.assertIn('warble #2<', resp.text)
+            self.assertIn('warble #1<', resp.text)
+
+    def test_bad_cursor(self):
+        """Is a malformed cursor rejected?"""
+        with self.client as c:
+            resp = c.get(f"/users/{self.user2.id}?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+            #well formed, but with the wrong types for the list's sort key
+            for url, cursor in ((f"/users/{self.user2.id}", encode_cursor([1], 2)),
+                                (f"/users/{self.user2.id}", encode_cursor(1, 2)),
+                                ("/users", encode_cursor(datetime(2024, 1, 1), 2)),
+                                ("/users", encode_cursor(True, 2)),
+                                ("/messages/search?q=warble&sort=rank",
+                                 encode_cursor('1', 2))):
+                sep = '&' if '?' in url else '?'
+                resp = c.get(f"{url}{sep}before={cursor}")
+                self.assertEqual(resp.status_code, 400, url)
+
+    #################################################################
+    # CONDITIONAL GET TESTS
+    #################################################################
+    def test_profile_not_modified(self):
+        """Is an unchanged profile answered with a 304, and a changed one not?"""
+        db.session.add(Message(text='first warble', user_id=self.user2.id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user2.id}")
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=0, s-maxage=30')
+            self.assertIn('Cookie', resp.headers['Vary'])
+
+            resp = c.get(f"/users/{self.user2.id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+
+            msg = Message(text='second warble', user_id=self.user2.id)
+            db.session.add(msg)
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.user2.id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('second warble', resp.text)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_not_modified_per_viewer(self):
+        """Does following someone change the ETag of their page?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/users/{self.user3.id}")
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = c.get(f"/users/{self.user3.id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/users/follow/{self.user3.id}")
+            # the follow flashed nothing, so the page can be compared again
+            resp = c.get(f"/users/{self.user3.id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Unfollow', resp.text)
+
+            # and the followers list notices the new follower
+            resp = c.get(f"/users/{self.user3.id}/followers")
+            etag = resp.headers['ETag']
+            self.user2.username = 'renamed2'
+            db.session.add(Follows(user_being_followed_id=self.user3.id,
+                                   user_following_id=self.user2.id))
+            db.session.commit()
+            resp = c.get(f"/users/{self.user3.id}/followers", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('renamed2', resp.text)
+
+    def test_uncached_routes(self):
+        """Do other routes still say not to cache them?"""
+        with self.client as c:
+            resp = c.get('/users')
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+            self.assertNotIn('ETag', resp.headers)
+
+            resp = c.get(f"/users/{self.user2.id}/following")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+    #################################################################
+    # STATIC ASSET TESTS
+    #################################################################
+    def test_fingerprinted_assets(self):
+        """Do pages use built assets, sent precompressed and immutable?"""
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = build_assets.build(out=tmp)
+            css = manifest['files']['stylesheets/style.css']
+            self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{10}\.css$')
+            self.assertIn(css, manifest['compressed'])
+
+            plain = app.extensions['assets']
+            app.extensions['assets'] = assets.Assets(os.path.join(tmp, 'manifest.json'))
+            try:
+                self.user2.image_url = '/static/images/default-pic.png'
+                db.session.commit()
+
+                with self.client as c:
+                    resp = c.get('/users')
+                    self.assertIn(f'/static/dist/{css}', resp.text)
+                    # so do the default pictures
+                    pic = manifest['files']['images/default-pic.png']
+                    self.assertIn(f'src="/static/dist/{pic}"', resp.text)
+
+                    resp = c.get(f'/static/dist/{css}', headers={'Accept-Encoding': 'gzip'})
+                    self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+                    self.assertEqual(resp.mimetype, 'text/css')
+                    self.assertIn('immutable', resp.headers['Cache-Control'])
+                    self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+                    text = gzip.decompress(resp.data).decode()
+                    # url()s point at the hashed images
+                    self.assertIn(manifest['files']['images/nav-bg.png'].split('/')[-1], text)
+
+                    resp = c.get(f'/static/dist/{css}')
+                    self.assertNotIn('Content-Encoding', resp.headers)
+                    self.assertIn(b'url(', resp.data)
+            finally:
+                app.extensions['assets'] = plain
+
+    #################################################################
+    # IMAGE PROXY TESTS
+    #################################################################
+    def test_image_proxy(self):
+        """Are remote avatars fetched once, then served locally?"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubImageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        StubImageHandler.hits.clear()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        plain = app.extensions['image_proxy']
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                proxy = images.ImageProxy(tmp, app.config['SECRET_KEY'], wait=10,
+                                          allowed_networks=['127.0.0.1/32'])
+                app.extensions['image_proxy'] = proxy
+
+                self.user2.image_url = f"{base}/avatar.png"
+                db.session.commit()
+
+                with self.client as c:
+                    resp = c.get(f"/users/{self.user2.id}")
+                    url = re.search(r'src="(/images/avatar/[^"]+)"', resp.text).group(1)
+                    url = url.replace('&amp;', '&')
+
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn('immutable', resp.headers['Cache-Control'])
+                    self.assertEqual(resp.headers['X-Content-Type-Options'], 'nosniff')
+                    self.assertEqual(resp.headers['Content-Security-Policy'],
+                                     "default-src 'none'")
+                    if images.pillow()[0] is None:
+                        self.assertEqual(resp.data, PIXEL)
+
+                    # every variant was made by that one fetch
+                    resp = c.get(url.replace('/avatar/', '/thumb/'))
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertEqual(StubImageHandler.hits, ['/avatar.png'])
+
+                    # keys are signed, so this isn't an open proxy
+                    resp = c.get(url.replace('avatar.png', 'other.png'))
+                    self.assertEqual(resp.status_code, 404)
+
+                    # not an image: send the browser to the source instead
+                    src = f"{base}/page"
+                    resp = c.get(f"/images/thumb/{proxy.key(src)}?src={src}")
+                    self.assertEqual(resp.status_code, 302)
+                    self.assertEqual(resp.location, src)
+                proxy.shutdown()
+        finally:
+            app.extensions['image_proxy'] = plain
+            server.shutdown()
+            server.server_close()
+
+    def test_image_proxy_private_addresses(self):
+        """Does the proxy refuse to fetch from private addresses?"""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubImageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        StubImageHandler.hits.clear()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                # loopback isn't allowed by default: nothing is requested
+                proxy = images.ImageProxy(tmp, 'secret')
+                with self.assertRaises(images.ImageFetchError):
+                    proxy.download(f"{base}/avatar.png")
+                self.assertEqual(StubImageHandler.hits, [])
+                proxy.shutdown()
+
+                # redirects only go to http(s)
+                proxy = images.ImageProxy(tmp, 'secret',
+                                          allowed_networks=['127.0.0.1/32'])
+                with self.assertRaises(images.ImageFetchError):
+                    proxy.download(f"{base}/to-ftp")
+
+                # only raster images, by type and by content
+                for path in ('/evil.svg', '/evil.png', '/page'):
+                    with self.assertRaises(images.ImageFetchError):
+                        proxy.download(f"{base}{path}")
+                self.assertEqual(proxy.download(f"{base}/avatar.png"), (PIXEL, '.png'))
+                proxy.shutdown()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        for address in ('127.0.0.1', '10.0.0.1', '192.168.1.1', '169.254.169.254',
+                        '::1', 'fe80::1', '::ffff:127.0.0.1', '0.0.0.0'):
+            self.assertFalse(images.is_public(address), address)
+        self.assertTrue(images.is_public('93.184.216.34'))
+
+    #################################################################
+    # READ REPLICA TESTS
+    #################################################################
+    def test_read_replica(self):
+        """Do read-only pages use the replica, except just after a write?"""
+        primary = app.extensions['replicas']
+        with tempfile.TemporaryDirectory() as tmp:
+            replica = replicas.Replicas([f"sqlite:///{tmp}/replica.db"])
+            db.metadata.create_all(replica.engines[0])
+            with replica.engines[0].begin() as conn:
+                conn.execute(User.__table__.insert().values(
+                    id=50, username='replica_only', email='r@example.com',
+                    password='password'))
+
+            user_id = self.testuser.id
+            app.extensions['replicas'] = replica
+            try:
+                with self.client as c:
+                    resp = c.get('/users')
+                    self.assertIn('@replica_only', resp.text)
+                    self.assertNotIn('@user2', resp.text)
+
+                    # writes always go to the primary...
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = user_id
+                    resp = c.post('/messages/new', data={'text': 'on the primary'})
+                    self.assertEqual(resp.status_code, 302)
+                    self.assertEqual(Message.query.filter_by(text='on the primary').count(), 1)
+
+                    # ...and so do this session's reads for a little while
+                    resp = c.get('/users')
+                    self.assertIn('@user2', resp.text)
+                    self.assertNotIn('@replica_only', resp.text)
+
+                    with c.session_transaction() as sess:
+                        sess[replicas.PIN_KEY] = 0
+                    resp = c.get('/users')
+                    self.assertIn('@replica_only', resp.text)
+            finally:
+                app.extensions['replicas'] = primary
+                db.session.rollback()
+                db.session.expunge_all()
+                replica.dispose()
+
+    #################################################################
+    # APP FACTORY TESTS
+    #################################################################
+    def test_create_app_after_fork(self):
+        """Do forked production workers get their own database connections?"""
+        prod = create_app('production')
+        self.assertIsNot(prod, app)
+        self.assertFalse(prod.config['DEBUG_TOOLBAR'])
+
+        with prod.app_context():
+            engine = db.engine
+            engine.connect().close()
+            pool = engine.pool
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if engine.pool is not pool else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(engine.pool, pool)
+
+    def test_db_pool_exhausted(self):
+        """Is a request that can't get a connection turned away quickly?"""
+        with tempfile.TemporaryDirectory() as tmp:
+            small = create_app('test', SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp}/pool.db",
+                               DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=0.1,
+                               EXPOSE_INTERNAL_STATS=True)
+            with small.app_context():
+                db.create_all()
+                engine = db.engine
+            client = small.test_client()
+
+            held = engine.connect()
+            try:
+                resp = client.get('/users')
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers['Retry-After'], '1')
+            finally:
+                held.close()
+
+            self.assertEqual(client.get('/users').status_code, 200)
+
+            stats = client.get('/_stats/db-pool').json['primary']
+            self.assertEqual(stats['timeouts'], 1)
+            self.assertEqual(stats['size'], 1)
+            self.assertGreaterEqual(stats['checkouts'], 3)
+            engine.dispose()
+
+    def test_engine_options(self):
+        """Do the DB_* settings reach the engine options?"""
+        options = pooling.engine_options({
+            'SQLALCHEMY_DATABASE_URI': 'postgresql:///warbler',
+            'DB_POOL_SIZE': 20, 'DB_STATEMENT_TIMEOUT_MS': 3000})
+        self.assertEqual(options['pool_size'], 20)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=3000'})
+
+        # nothing to size or time out on an in-memory SQLite database
+        options = pooling.engine_options({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DB_STATEMENT_TIMEOUT_MS': 3000})
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('connect_args', options)
+
+    #################################################################
+    # QUERY COUNTING TESTS
+    #################################################################
+    def test_query_count_headers(self):
+        """Are SQL statement counts reported on each response?"""
+        with self.client as c:
+            resp = c.get(f"/users/{self.user2.id}")
+
+            self.assertGreater(int(resp.headers['X-Query-Count']), 0)
+            self.assertIn('X-Query-Time-Ms', resp.headers)
+
+    def test_failed_query_counted(self):
+        """Are statements that raise counted, and their timers cleared?"""
+        with self.client as c:
+            resp = c.post('/signup', data={'username': 'user2',
+                                           'email': 'new@email.com',
+                                           'password': 'password'})
+            self.assertIn('Username already taken', resp.text)
+            self.assertEqual(resp.headers['X-Query-Failed'], '1')
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.exec_driver_sql("SELECT * FROM no_such_table")
+            self.assertEqual(conn.info['query_start'], [])
+
+    def test_query_budget(self):
+        """Does going over a route's query budget fail loudly?"""
+        app.config['QUERY_BUDGETS'] = {'warbler.users_show': 0}
+        app.config['QUERY_BUDGET_RAISE'] = True
+        app.testing = True
+
+        try:
+            with self.client as c:
+                with self.assertRaises(QueryBudgetExceeded):
+                    c.get(f"/users/{self.user2.id}")
+        finally:
+            del app.config['QUERY_BUDGETS'], app.config['QUERY_BUDGET_RAISE']
+            app.testing = False
+
+    def test_n_plus_one_detected(self):
+        """Are repeated statements flagged with the template that ran them?"""
+        stats = QueryStats()
+        for i in range(3):
+            stats.record('SELECT * FROM users WHERE users.id = ?', (i,), 0.001)
+        stats.record('SELECT * FROM messages WHERE id IN (?, ?)', (1, 2), 0.001)
+        stats.record('SELECT * FROM messages WHERE id IN (?)', (3,), 0.001)
+
+        suspects = stats.suspected_n_plus_one(threshold=2)
+        self.assertEqual([s['count'] for s in suspects], [3, 2])
+        self.assertIn('test_user_views.py', suspects[0]['site'])
+
+    #################################################################
+    # SEARCH TESTS
+    #################################################################
+    def test_search_users(self):
+        """Does search match usernames, bios and locations, best first?"""
+        self.user2.bio = 'I love user3 a lot'
+        self.user3.location = 'Testuserville'
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/users?q=user3')
+            res_str = resp.text
+
+            self.assertIn('@user3', res_str)
+            self.assertIn('@user2', res_str)
+            self.assertNotIn('@testuser', res_str)
+            #exact username match ranks above a bio match
+            self.assertLess(res_str.index('@user3'), res_str.index('@user2'))
+
+            resp = c.get('/users?q=TESTUSER')
+            self.assertIn('@testuser', resp.text)
+            self.assertIn('@user3', resp.text)
+
+    def test_search_users_paginates(self):
+        """Are search results paginated with cursors?"""
+        with self.client as c:
+            #username prefix matches first, then substrings
+            resp = c.get('/users?q=user&limit=2')
+            self.assertIn('@user2', resp.text)
+            self.assertIn('@user3', resp.text)
+            self.assertNotIn('@testuser', resp.text)
+
+            match = re.search(r'href="([^"]*before=[^"]*)"', resp.text)
+            resp = c.get(match.group(1).replace('&amp;', '&'))
+            self.assertIn('@testuser', resp.text)
+            self.assertNotIn('@user2', resp.text)
+
+    def test_search_short_term(self):
+        """Do terms too short for trigrams fall back to username prefixes?"""
+        with self.client as c:
+            resp = c.get('/users?q=us')
+            self.assertIn('@user2', resp.text)
+            self.assertNotIn('@testuser', resp.text)
+
+    #################################################################
+    # USER CACHE TESTS
+    #################################################################
+    def test_user_cache(self):
+        """Is the current user served from cache and refreshed after changes?"""
+        cache = app.extensions['user_cache']
+        db.session.expunge_all()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.get('/users/2')
+            db.session.expunge_all()
+            hits = cache.hits
+
+            #second request needs no query for the current user
+            resp = c.get('/users/2')
+            self.assertEqual(cache.hits, hits + 1)
+            self.assertIn('Follow', resp.text)
+
+            #following invalidates both users' entries
+            c.post('/users/follow/2')
+            self.assertEqual(len(cache), 0)
+
+            db.session.expunge_all()
+            resp = c.get('/')
+            self.assertIn('<a href="/users/1/following">1</a>', resp.text)
+
+    def test_user_cache_other_worker(self):
+        """Does a write skip entries cached before it, not just invalidated ones?"""
+        cache = app.extensions['user_cache']
+        db.session.expunge_all()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.get('/')
+            stale = cache.get(1)
+
+            c.post('/users/follow/2')
+
+            #another worker still has the entry from before the follow
+            cache.set(1, stale)
+            db.session.expunge_all()
+            resp = c.get('/')
+            self.assertIn('<a href="/users/1/following">1</a>', resp.text)
+            self.assertIsNot(cache.get(1), stale)
+
+    def test_user_cache_lru(self):
+        """Does the cache evict least recently used entries and expire old ones?"""
+        now = [0]
+        cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.get(1)
+        cache.set(3, 'c')
+
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 'a')
+
+        now[0] = 11
+        self.assertIsNone(cache.get(3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['expirations'], 1)
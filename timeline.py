@@ -0,0 +1,213 @@
+"""Precomputed home timelines for Warbler.
+
+Each user has an inbox of `TimelineEntry` rows. Posting a message writes it
+into the inbox of the author and every follower (fan-out-on-write), so reading
+the homepage is a single indexed range scan.
+
+Authors with a very large number of followers would turn every post into a
+huge write, so their messages are NOT fanned out. Instead, the homepage merges
+their recent messages in when the feed is read (fan-out-on-read).
+
+The first time such an author posts or gains a follower over the limit
+(whenever a fan-out or backfill is skipped), `User.fanout_on_read` is set.
+It stays set even if they drop back under the limit: the messages skipped
+meanwhile are in nobody's inbox, so their followers must keep reading them
+at request time. `rebuild()` starts over from the current follower counts.
+
+Feeds find the followed authors to merge in from that flag alone. The
+partial index on it holds only those few authors, and each one costs a
+probe of the viewer's follows, however many people the viewer follows.
+"""
+
+from flask import current_app
+from sqlalchemy import delete, insert, literal, or_, select, update
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import keyset, make_page
+from projections import message_rows, select_messages
+
+# authors with at least this many followers are read at request time
+DEFAULT_FANOUT_LIMIT = 10000
+
+# how many of a user's recent messages are copied in when you follow them
+DEFAULT_BACKFILL = 100
+
+
+def fanout_limit():
+    """Follower count at which an author switches to fan-out-on-read."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+
+
+def read_side():
+    """Condition on `User` for fan-out-on-read authors."""
+
+    return or_(User.fanout_on_read, User.followers_count >= fanout_limit())
+
+
+def is_fanout_on_read(user_id):
+    """Is this author too popular to fan out on write (or were they, once)?"""
+
+    return bool(db.session.scalar(
+        select(read_side()).where(User.id == user_id)))
+
+
+def mark_fanout_on_read(user_id):
+    """Flag an author whose messages stopped reaching their followers' inboxes."""
+
+    db.session.execute(update(User)
+                       .where(User.id == user_id, ~User.fanout_on_read)
+                       .values(fanout_on_read=True))
+
+
+def celebrity_ids(user_id):
+    """Ids of the fan-out-on-read authors that `user_id` follows."""
+
+    # driven from ix_users_fanout_on_read, not from the viewer's follows
+    followed = (select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == user_id,
+                       Follows.user_being_followed_id == User.id)
+                .exists())
+    popular = select(User.id).where(User.fanout_on_read, followed)
+
+    return db.session.scalars(popular).all()
+
+
+def fan_out(msg):
+    """Deliver a freshly flushed message to its author's and followers' inboxes.
+
+    Runs in the caller's transaction; the caller commits.
+    """
+
+    cols = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+    db.session.execute(insert(TimelineEntry).values(
+        owner_id=msg.user_id,
+        message_id=msg.id,
+        author_id=msg.user_id,
+        timestamp=msg.timestamp))
+
+    if is_fanout_on_read(msg.user_id):
+        # from now on this author's followers read them at request time
+        mark_fanout_on_read(msg.user_id)
+        return
+
+    followers = (select(Follows.user_following_id,
+                        literal(msg.id),
+                        literal(msg.user_id),
+                        literal(msg.timestamp))
+                 .where(Follows.user_being_followed_id == msg.user_id,
+                        Follows.user_following_id != msg.user_id))
+
+    db.session.execute(insert(TimelineEntry).from_select(cols, followers))
+
+
+def backfill(follower_id, followed_id):
+    """Copy the followed user's recent messages into the follower's inbox."""
+
+    if is_fanout_on_read(followed_id):
+        # this follower reads them at request time instead
+        mark_fanout_on_read(followed_id)
+        return
+
+    limit = current_app.config.get('TIMELINE_BACKFILL', DEFAULT_BACKFILL)
+
+    recent = (select(literal(follower_id),
+                     Message.id,
+                     Message.user_id,
+                     Message.timestamp)
+              .where(Message.user_id == followed_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit))
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['owner_id', 'message_id', 'author_id', 'timestamp'], recent))
+
+
+def prune_author(owner_id, author_id):
+    """Remove an author's messages from someone's inbox (on unfollow)."""
+
+    db.session.execute(delete(TimelineEntry).where(
+        TimelineEntry.owner_id == owner_id,
+        TimelineEntry.author_id == author_id))
+
+
+def forget_user(user_id):
+    """Remove a deleted user's inbox and their messages from every inbox."""
+
+    db.session.execute(delete(TimelineEntry).where(
+        (TimelineEntry.owner_id == user_id) | (TimelineEntry.author_id == user_id)))
+
+
+def prune_message(message_id):
+    """Remove a deleted message from every inbox."""
+
+    db.session.execute(delete(TimelineEntry).where(
+        TimelineEntry.message_id == message_id))
+
+
+def home_feed(user_id, before=None, after=None, limit=100):
+    """One page of `user_id`'s homepage feed, newest first, as a `Page` of
+    `MessageRow`s.
+
+    Reads the precomputed inbox and merges in the messages of any followed
+    fan-out-on-read authors. `before` / `after` are decoded (timestamp, id)
+    cursors; see `pagination`.
+    """
+
+    inbox = db.session.execute(keyset(
+        select(TimelineEntry.timestamp, TimelineEntry.message_id)
+        .where(TimelineEntry.owner_id == user_id),
+        (TimelineEntry.timestamp, TimelineEntry.message_id),
+        before, after, limit)).all()
+
+    celebs = celebrity_ids(user_id)
+    if celebs:
+        inbox += db.session.execute(keyset(
+            select(Message.timestamp, Message.id)
+            .where(Message.user_id.in_(celebs)),
+            (Message.timestamp, Message.id),
+            before, after, limit)).all()
+        inbox = sorted(set(inbox), reverse=after is None)
+
+    # trim before loading so make_page still sees the extra row
+    inbox = inbox[:limit + 1]
+    page = make_page(inbox, tuple, before, after, limit)
+
+    ids = [message_id for _, message_id in page.items]
+    page.items = message_rows(db.session.execute(
+        select_messages()
+        .where(Message.id.in_(ids))
+        .order_by(Message.timestamp.desc(), Message.id.desc()))) if ids else []
+
+    return page
+
+
+def rebuild():
+    """Rebuild every inbox from messages and follows (e.g. after seeding).
+
+    Fan-out-on-read authors only get their own messages in their own inbox.
+    Which authors those are is decided afresh from `User.followers_count`,
+    so reconcile counters first.
+    """
+
+    limit = fanout_limit()
+    cols = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+    db.session.execute(update(User).values(
+        fanout_on_read=User.followers_count >= limit))
+    db.session.execute(delete(TimelineEntry))
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        cols,
+        select(Message.user_id, Message.id, Message.user_id, Message.timestamp)))
+
+    popular = select(User.id).where(User.fanout_on_read)
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        cols,
+        select(Follows.user_following_id, Message.id, Message.user_id,
+               Message.timestamp)
+        .join(Message, Message.user_id == Follows.user_being_followed_id)
+        .where(Follows.user_being_followed_id.not_in(popular),
+               Follows.user_following_id != Follows.user_being_followed_id)))
@@ -0,0 +1,128 @@
+"""Per-process cache of the logged-in user.
+
+Every request used to load the current user with a query, and pages then
+lazily loaded the ids of who they follow and what they've liked. This caches,
+per user id:
+
+- the user's column values (including the denormalized counters)
+- the ids of the users they follow
+- the ids of the messages they've liked
+
+On a hit, `g.user` is rebuilt from the cached columns and attached to the
+session without any SQL, so it can still be changed and committed like any
+loaded `User`.
+
+Routes that change any of this call `invalidate()` after committing, but
+that only reaches the worker that ran the route. So committing a write
+during a request also stamps the browser session with the time, the way
+replicas.py pins it to the primary, and entries cached before that stamp
+are misses. Whoever wrote sees it on their next request, whichever worker
+serves it; everyone else sees it when their entry's TTL runs out.
+
+Settings: USER_CACHE_SIZE (entries, default 1024; 0 disables the cache) and
+USER_CACHE_TTL (seconds, default 30).
+"""
+
+import time
+
+from flask import current_app, has_request_context, session
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from caching import LRUCache
+from models import db, User
+from replicas import RoutingSession
+
+WRITE_KEY = '_wrote_at'
+
+
+class CachedUser:
+    """What's cached for one user."""
+
+    __slots__ = ('columns', 'following_ids', 'liked_ids', 'loaded_at')
+
+    def __init__(self, columns, following_ids, liked_ids, loaded_at=None):
+        self.columns = columns
+        self.following_ids = following_ids
+        self.liked_ids = liked_ids
+        # wall clock, since it's compared with stamps from other workers
+        self.loaded_at = time.time() if loaded_at is None else loaded_at
+
+    @classmethod
+    def load(cls, user):
+        """Snapshot a loaded `User` and their follow / like ids."""
+
+        columns = {col.key: getattr(user, col.key)
+                   for col in User.__mapper__.column_attrs}
+
+        following_ids, liked_ids = user.follow_and_like_ids()
+
+        return cls(columns, following_ids, liked_ids)
+
+
+def get_cache():
+    """This app's cache of current users."""
+
+    return current_app.extensions['user_cache']
+
+
+def load_user(user_id):
+    """Current user for `user_id` as (User, CachedUser), or (None, None).
+
+    On a cache hit no SQL runs.
+    """
+
+    cache = get_cache()
+    entry = cache.get(user_id)
+
+    # this browser wrote something since the entry was cached (maybe on
+    # another worker, which couldn't invalidate ours)
+    if entry is not None and entry.loaded_at < session.get(WRITE_KEY, 0):
+        entry = None
+
+    if entry is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None, None
+
+        entry = CachedUser.load(user)
+        cache.set(user_id, entry)
+        return user, entry
+
+    # already loaded in this session (e.g. by a test); reuse that instance
+    user = db.session.identity_map.get(identity_key(User, user_id))
+
+    if user is None:
+        user = User(**entry.columns)
+        make_transient_to_detached(user)
+        db.session.add(user)
+
+    return user, entry
+
+
+def invalidate(*user_ids):
+    """Forget cached state for these users (call after committing)."""
+
+    get_cache().invalidate(*user_ids)
+
+
+def stamp_write():
+    """Mark this browser session as having written just now."""
+
+    session[WRITE_KEY] = time.time()
+
+
+# inserted ahead of replicas.py's listener, which clears the 'wrote' flag
+@event.listens_for(RoutingSession, 'after_commit', insert=True)
+def _committed(db_session):
+    if db_session.info.get('wrote') and has_request_context():
+        stamp_write()
+
+
+def init_app(app):
+    """Give `app` its own current-user cache."""
+
+    app.extensions['user_cache'] = LRUCache(
+        maxsize=app.config.get('USER_CACHE_SIZE', 1024),
+        ttl=app.config.get('USER_CACHE_TTL', 30))
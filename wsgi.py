@@ -0,0 +1,12 @@
+"""Entry point for production servers.
+
+    gunicorn --preload --workers 4 wsgi:app
+
+--preload builds the app once, before forking, so the workers share its
+memory; each worker then opens its own database connections (see
+`dispose_engines_after_fork()` in app.py).
+"""
+
+from app import create_app
+
+app = create_app('production')